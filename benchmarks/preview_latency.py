@@ -0,0 +1,82 @@
+# Compares GUI-thread latency while the preview plays with in-process decoding and with the frame server.
+# A precise timer ticks on the GUI thread, how late each tick fires is how long the GUI was blocked.
+#
+#     python benchmarks/preview_latency.py --seconds 10 video.mp4
+
+import os
+import sys
+import argparse
+import statistics
+import multiprocessing
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtWidgets import QApplication, QTimeEdit
+
+from preview import PreviewSurface, VideoPreviewWidget, StreamDecoder
+from frameserver import RemoteDecoder
+from probe import probe_media, keyframe_index
+
+DECODERS = {
+    'in-process': StreamDecoder,
+    'frame server': RemoteDecoder,
+}
+
+
+def measure(app, path, decoder_factory, seconds, interval_ms):
+    surface = PreviewSurface()
+    surface.resize(640, 360)
+    surface.show()
+    preview_video = VideoPreviewWidget(path, probe_media(path), surface, QTimeEdit(), keyframe_index(path), decoder_factory=decoder_factory)
+
+    lateness = []
+    last_tick = [None]
+
+    def tick():
+        now = perf_counter()
+        if last_tick[0] is not None:
+            lateness.append(max(0.0, (now - last_tick[0]) * 1000 - interval_ms))
+        last_tick[0] = now
+
+    timer = QTimer()
+    timer.setTimerType(Qt.PreciseTimer)
+    timer.timeout.connect(tick)
+    timer.start(interval_ms)
+    QTimer.singleShot(int(seconds * 1000), app.quit)
+    app.exec()
+    timer.stop()
+
+    result = {
+        'frames': surface.painted_frames,
+        'dropped': preview_video.frame_grab.dropped_frames,
+        'frame_ms': surface.frame_cost(),
+        'mean_ms': statistics.mean(lateness) if lateness else 0.0,
+        'p95_ms': statistics.quantiles(lateness, n=20)[-1] if len(lateness) > 1 else 0.0,
+        'max_ms': max(lateness, default=0.0),
+    }
+    preview_video.shutdown()
+    surface.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure GUI-thread latency of the preview decoders.")
+    parser.add_argument('input', help="video file to play")
+    parser.add_argument('--seconds', type=float, default=10, help="playback time per decoder")
+    parser.add_argument('--interval', type=int, default=5, help="GUI timer interval in milliseconds")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    print(f"{'decoder':<14}{'frames':>8}{'dropped':>9}{'gui ms/frame':>14}{'late mean':>11}{'late p95':>10}{'late max':>10}")
+    for name, decoder_factory in DECODERS.items():
+        result = measure(app, args.input, decoder_factory, args.seconds, args.interval)
+        print(f"{name:<14}{result['frames']:>8}{result['dropped']:>9}{result['frame_ms']:>14.2f}"
+              f"{result['mean_ms']:>11.2f}{result['p95_ms']:>10.2f}{result['max_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
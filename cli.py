@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import export
+from probe import probe_media
+
+MODES = ["reencode", "copy", "smart", "ffmpeg", "parallel"]
+
+
+def parse_time(value):
+    # Accepts plain seconds or HH:MM:SS(.fff)
+    seconds = 0.0
+    for part in value.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='videoeditor', description="Trim, resize and re-encode videos without the GUI.")
+    parser.add_argument('inputs', nargs='+', help="input video files")
+    parser.add_argument('-o', '--output', help="output file name, only valid with a single input")
+    parser.add_argument('--output-dir', help="directory for the outputs, named <input>-modified.mp4")
+    parser.add_argument('--start', type=parse_time, default=0, help="clip start in seconds or HH:MM:SS")
+    parser.add_argument('--end', type=parse_time, help="clip end in seconds or HH:MM:SS")
+    parser.add_argument('--width', type=int, help="output width, used together with --height")
+    parser.add_argument('--height', type=int, help="output height, used together with --width")
+    parser.add_argument('--volume', type=int, default=100, help="volume in percent (0-200)")
+    parser.add_argument('--bitrate', type=int, help="video bitrate in kbit/s")
+    parser.add_argument('--mode', choices=MODES, default="reencode", help="export engine")
+    parser.add_argument('--segments', type=int, help="segment count for --mode parallel")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="number of inputs processed at the same time")
+    args = parser.parse_args(argv)
+    if args.output and len(args.inputs) > 1:
+        parser.error("--output can only be used with a single input, use --output-dir instead")
+    if args.mode == "copy" and (args.width or args.height or args.bitrate or args.volume != 100):
+        parser.error("--mode copy cannot change resolution, bitrate or volume")
+    return args
+
+
+def job_settings(args, input_file):
+    if args.output:
+        output_file = args.output.removesuffix('.mp4')
+    elif args.output_dir:
+        output_file = os.path.join(args.output_dir, os.path.splitext(os.path.basename(input_file))[0] + '-modified')
+    else:
+        output_file = None
+    return {
+        'input_file': input_file,
+        'output_file': output_file,
+        'clip_begin': args.start,
+        'clip_end': args.end,
+        'resolution_w': args.width,
+        'resolution_h': args.height,
+        'volume': args.volume / 100,
+        'new_bitrate': args.bitrate,
+        'mode': args.mode,
+        'segments': args.segments,
+    }
+
+
+def run_cli_job(index, settings, events):
+    started = time.monotonic()
+    if settings['mode'] == "copy":
+        duration = probe_media(settings['input_file'])['duration']
+        settings['clip_begin'], settings['clip_end'] = export.snap_to_keyframes(settings['input_file'], settings['clip_begin'], settings['clip_end'], duration)
+        events.put({'event': 'snapped', 'job': index, 'start': settings['clip_begin'], 'end': settings['clip_end']})
+    output_file = export.run_job(progress=lambda fraction: events.put({'event': 'progress', 'job': index, 'percent': int(fraction * 100)}), **settings)
+    return output_file, time.monotonic() - started
+
+
+def emit(event):
+    print(json.dumps(event), flush=True)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    started = time.monotonic()
+    failed = 0
+    last_percent = {}
+
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        events = manager.Queue()
+        futures = {}
+        for index, input_file in enumerate(args.inputs):
+            future = executor.submit(run_cli_job, index, job_settings(args, input_file), events)
+            futures[future] = index
+            emit({'event': 'queued', 'job': index, 'input': input_file})
+
+        def forward(event):
+            # Only changes of whole percents are printed to keep the stream small
+            if event['event'] != 'progress' or last_percent.get(event['job']) != event['percent']:
+                last_percent[event['job']] = event.get('percent')
+                emit(event)
+
+        def drain():
+            while True:
+                try:
+                    forward(events.get_nowait())
+                except queue.Empty:
+                    return
+
+        pending = set(futures)
+        while pending:
+            try:
+                forward(events.get(timeout=0.2))
+            except queue.Empty:
+                pass
+            finished = [future for future in pending if future.done()]
+            # A finished job has put all its events already, they are printed before its done or error
+            if finished:
+                drain()
+            for future in finished:
+                pending.discard(future)
+                index = futures[future]
+                try:
+                    output_file, seconds = future.result()
+                    emit({'event': 'done', 'job': index, 'input': args.inputs[index], 'output': output_file, 'seconds': round(seconds, 3)})
+                except Exception as e:
+                    failed += 1
+                    emit({'event': 'error', 'job': index, 'input': args.inputs[index], 'error': export.error_message(e)})
+        drain()
+
+    emit({'event': 'summary', 'jobs': len(args.inputs), 'failed': failed, 'seconds': round(time.monotonic() - started, 3)})
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
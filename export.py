@@ -0,0 +1,478 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+import proglog
+from moviepy.video.io.VideoFileClip import VideoFileClip
+import moviepy.audio.fx.all as afx
+
+from probe import probe_media, keyframe_index
+
+
+# Set inside an export process when the job is cancelled, checked wherever ffmpeg or moviepy report progress
+cancel_requested = threading.Event()
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def check_cancelled(cancelled=None):
+    if (cancelled or cancel_requested.is_set)():
+        raise ExportCancelled("Export cancelled")
+
+
+def resolve_output_file(input_file, output_file):
+    if not output_file:
+        return os.path.splitext(input_file)[0] + '-modified.mp4'
+    return output_file + '.mp4'
+
+
+def snap_to_keyframes(input_file, clip_begin, clip_end, duration=None, keyframes=None):
+    # The GUI passes the index it already built, reading it here demuxes the whole file
+    if keyframes is None:
+        keyframes = keyframe_index(input_file)
+    begin = keyframes.nearest(clip_begin)
+    if clip_end is None or (duration is not None and clip_end >= duration):
+        end = duration
+    else:
+        end = keyframes.nearest(clip_end)
+        if end <= begin:
+            end = clip_end
+    return begin, end
+
+
+def run_ffmpeg(stream, duration, progress=None, cancelled=None):
+    # Progress is read from ffmpeg's own -progress report, reported as a 0..1 fraction
+    stream = stream.global_args('-progress', 'pipe:1', '-nostats', '-loglevel', 'error')
+    # stderr goes to a file, a damaged input can log more than a pipe holds and would block ffmpeg
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen(stream.overwrite_output().compile(), stdout=subprocess.PIPE, stderr=log)
+        try:
+            for line in process.stdout:
+                check_cancelled(cancelled)
+                key, _, value = line.decode(errors='replace').strip().partition('=')
+                if progress and duration and key == 'out_time_us' and value.isdigit():
+                    progress(min(int(value) / 1_000_000 / duration, 1.0))
+        except BaseException:
+            # Cancelled or failed, ffmpeg must not outlive the export
+            process.kill()
+            process.wait()
+            raise
+        if process.wait() != 0:
+            log.seek(0)
+            raise ffmpeg.Error('ffmpeg', None, log.read())
+    if progress:
+        progress(1.0)
+
+
+def fast_trim(input_file, output_file, clip_begin, clip_end, progress=None):
+    # Stream copy, the caller is expected to pass keyframe-snapped times
+    input_kwargs = {'ss': clip_begin}
+    duration = None
+    if clip_end is not None:
+        duration = clip_end - clip_begin
+        input_kwargs['t'] = duration
+    stream = ffmpeg.input(input_file, **input_kwargs).output(
+        output_file,
+        c='copy',
+        avoid_negative_ts='make_zero',
+        movflags='+faststart',
+    )
+    run_ffmpeg(stream, duration, progress)
+
+
+SMART_CUT_ENCODERS = {
+    'h264': 'libx264',
+    'hevc': 'libx265',
+}
+
+
+def scaled_progress(progress, start, span):
+    if progress is None:
+        return None
+    return lambda fraction: progress(start + fraction * span)
+
+
+def split_progress(progress, weights):
+    # One callback per step, each covering its share of the overall 0..1 range
+    total = sum(weights) or 1
+    callbacks = []
+    offset = 0
+    for weight in weights:
+        callbacks.append(scaled_progress(progress, offset / total, weight / total))
+        offset += weight
+    return callbacks
+
+
+# ffprobe profile names -> encoder profiles, unknown ones are left to the encoder
+H264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+    'High 10': 'high10',
+    'High 4:2:2': 'high422',
+    'High 4:4:4 Predictive': 'high444',
+}
+HEVC_PROFILES = {
+    'Main': 'main',
+    'Main 10': 'main10',
+    'Main Still Picture': 'mainstillpicture',
+}
+
+
+def encoder_profile(media_info):
+    # Re-encoded GOPs are muxed behind the copied ones' avcC/hvcC, so profile and level follow the source
+    profile = media_info.get('profile')
+    level = media_info.get('level')
+    if media_info['video_codec'] == 'h264':
+        options = {}
+        if profile in H264_PROFILES:
+            options['profile:v'] = H264_PROFILES[profile]
+        if level and level > 0:
+            # ffprobe reports 41 for level 4.1
+            options['level'] = f'{level / 10:g}'
+        return options
+    params = []
+    if profile in HEVC_PROFILES:
+        params.append(f'profile={HEVC_PROFILES[profile]}')
+    if level and level > 0:
+        # ffprobe reports 30 times the level, 123 for level 4.1
+        params.append(f'level-idc={level / 30:g}')
+    return {'x265-params': ':'.join(params)} if params else {}
+
+
+def encode_video_piece(input_file, piece_file, begin, end, media_info, progress=None):
+    # No -r, the source timestamps pass through, a VFR r_frame_rate such as 90000/1 would duplicate frames
+    output_kwargs = {
+        'vcodec': SMART_CUT_ENCODERS[media_info['video_codec']],
+        'pix_fmt': media_info['pix_fmt'] or 'yuv420p',
+        'vsync': 'passthrough',
+    }
+    output_kwargs.update(encoder_profile(media_info))
+    if media_info['video_bitrate']:
+        output_kwargs['video_bitrate'] = media_info['video_bitrate']
+    else:
+        output_kwargs['crf'] = 18
+    stream = ffmpeg.input(input_file, ss=begin, t=end - begin)['v:0'].output(piece_file, **output_kwargs)
+    run_ffmpeg(stream, end - begin, progress)
+
+
+def copy_video_piece(input_file, piece_file, begin, end, progress=None):
+    stream = ffmpeg.input(input_file, ss=begin, t=end - begin)['v:0'].output(piece_file, vcodec='copy')
+    run_ffmpeg(stream, end - begin, progress)
+
+
+def smart_cut(input_file, output_file, clip_begin, clip_end, volume=None, progress=None):
+    media_info = probe_media(input_file)
+    duration = media_info['duration']
+    if clip_end is None or clip_end > duration:
+        clip_end = duration
+
+    # Keyframes just inside the cut points, everything between them can be copied untouched
+    keyframes = keyframe_index(input_file)
+    head_end = keyframes.after(clip_begin)
+    tail_start = keyframes.before(clip_end)
+
+    pieces = []
+    if media_info['video_codec'] in SMART_CUT_ENCODERS and head_end is not None and tail_start is not None and head_end < tail_start:
+        if head_end > clip_begin:
+            pieces.append(('encode', clip_begin, head_end))
+        pieces.append(('copy', head_end, tail_start))
+        if clip_end > tail_start:
+            pieces.append(('encode', tail_start, clip_end))
+    elif media_info['video_codec'] in SMART_CUT_ENCODERS:
+        # No full GOP inside the range, the whole cut is re-encoded
+        pieces.append(('encode', clip_begin, clip_end))
+    else:
+        raise ValueError(f"Smart cut does not support {media_info['video_codec']} video")
+
+    # Copying costs a fraction of encoding, the final pass copies video and encodes audio
+    weights = [(end - begin) * (1 if kind == 'encode' else 0.05) for kind, begin, end in pieces]
+    weights.append((clip_end - clip_begin) * 0.1)
+    callbacks = split_progress(progress, weights)
+
+    work_dir = tempfile.mkdtemp(prefix='smartcut-', dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        # MPEG-TS pieces carry their parameter sets in-band, so re-encoded and copied GOPs concat cleanly
+        list_file = os.path.join(work_dir, 'pieces.txt')
+        with open(list_file, 'w') as f:
+            for index, (kind, begin, end) in enumerate(pieces):
+                piece_file = os.path.join(work_dir, f'piece{index}.ts')
+                if kind == 'encode':
+                    encode_video_piece(input_file, piece_file, begin, end, media_info, callbacks[index])
+                else:
+                    copy_video_piece(input_file, piece_file, begin, end, callbacks[index])
+                f.write(f"file '{piece_file}'\n")
+
+        video = ffmpeg.input(list_file, f='concat', safe=0)['v']
+        streams = [video]
+        output_kwargs = {'vcodec': 'copy', 'movflags': '+faststart'}
+        if media_info['audio_codec'] is not None:
+            audio = ffmpeg.input(input_file, ss=clip_begin, t=clip_end - clip_begin)['a:0']
+            if volume is not None and volume != 1.0:
+                audio = audio.filter('volume', volume)
+            streams.append(audio)
+            output_kwargs['acodec'] = 'aac'
+        stream = ffmpeg.output(*streams, output_file, **output_kwargs)
+        run_ffmpeg(stream, clip_end - clip_begin, callbacks[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def filter_export(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, progress=None):
+    # One ffmpeg process decodes, filters and encodes, no frames pass through Python
+    media_info = probe_media(input_file)
+    duration = media_info['duration']
+    if clip_end is None or clip_end > duration:
+        clip_end = duration
+    length = clip_end - clip_begin
+
+    source = ffmpeg.input(input_file, ss=clip_begin)
+    video = source['v:0'].trim(duration=length).setpts('PTS-STARTPTS')
+    if resolution_w and resolution_h:
+        video = video.filter('scale', resolution_w, resolution_h)
+    streams = [video]
+    output_kwargs = {
+        'vcodec': 'libx264',
+        'pix_fmt': 'yuv420p',
+        'movflags': '+faststart',
+    }
+    if new_bitrate:
+        output_kwargs['video_bitrate'] = f'{new_bitrate}k'
+    if media_info['audio_codec'] is not None:
+        audio = source['a:0'].filter('atrim', duration=length).filter('asetpts', 'PTS-STARTPTS')
+        if volume is not None and volume != 1.0:
+            audio = audio.filter('volume', volume)
+        streams.append(audio)
+        output_kwargs['acodec'] = 'aac'
+
+    stream = ffmpeg.output(*streams, output_file, **output_kwargs)
+    run_ffmpeg(stream, length, progress)
+
+
+def segment_bounds(keyframes, clip_begin, clip_end, segments):
+    # Split points land on keyframes so every segment starts with a cheap, exact seek
+    bounds = [clip_begin]
+    length = clip_end - clip_begin
+    for index in range(1, segments):
+        point = keyframes.nearest(clip_begin + length * index / segments)
+        if bounds[-1] < point < clip_end:
+            bounds.append(point)
+    bounds.append(clip_end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def encode_segment(input_file, segment_file, begin, end, resolution_w, resolution_h, new_bitrate, threads, progress_queue, index, stop=None):
+    # Runs in a worker process, progress goes back through a managed queue
+    video = ffmpeg.input(input_file, ss=begin)['v:0'].trim(duration=end - begin).setpts('PTS-STARTPTS')
+    if resolution_w and resolution_h:
+        video = video.filter('scale', resolution_w, resolution_h)
+    output_kwargs = {
+        'vcodec': 'libx264',
+        'pix_fmt': 'yuv420p',
+        'threads': threads,
+    }
+    if new_bitrate:
+        output_kwargs['video_bitrate'] = f'{new_bitrate}k'
+    stream = video.output(segment_file, **output_kwargs)
+    run_ffmpeg(stream, end - begin, lambda fraction: progress_queue.put((index, fraction)), stop.is_set if stop is not None else None)
+
+
+def parallel_export(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, segments=None, progress=None):
+    media_info = probe_media(input_file)
+    duration = media_info['duration']
+    if clip_end is None or clip_end > duration:
+        clip_end = duration
+    length = clip_end - clip_begin
+    segments = segments or os.cpu_count() or 1
+
+    keyframes = keyframe_index(input_file)
+    bounds = segment_bounds(keyframes, clip_begin, clip_end, segments)
+    threads = max(1, (os.cpu_count() or 1) // len(bounds))
+    encode_progress, mux_progress = split_progress(progress, [length, length * 0.1])
+
+    work_dir = tempfile.mkdtemp(prefix='segments-', dir=os.path.dirname(os.path.abspath(output_file)))
+    try:
+        segment_files = [os.path.join(work_dir, f'segment{index}.ts') for index in range(len(bounds))]
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=len(bounds)) as executor:
+            progress_queue = manager.Queue()
+            stop = manager.Event()
+            futures = [
+                executor.submit(encode_segment, input_file, segment_files[index], begin, end, resolution_w, resolution_h, new_bitrate, threads, progress_queue, index, stop)
+                for index, (begin, end) in enumerate(bounds)
+            ]
+            fractions = [0.0] * len(bounds)
+            try:
+                while not all(future.done() for future in futures):
+                    check_cancelled()
+                    try:
+                        index, fraction = progress_queue.get(timeout=0.2)
+                    except queue.Empty:
+                        continue
+                    fractions[index] = fraction
+                    if encode_progress:
+                        done = sum(fraction * (end - begin) for fraction, (begin, end) in zip(fractions, bounds))
+                        encode_progress(done / length)
+            except BaseException:
+                # Running segments kill their ffmpeg, queued ones never start
+                stop.set()
+                executor.shutdown(cancel_futures=True)
+                raise
+            for future in futures:
+                future.result()
+
+        list_file = os.path.join(work_dir, 'segments.txt')
+        with open(list_file, 'w') as f:
+            for segment_file in segment_files:
+                f.write(f"file '{segment_file}'\n")
+
+        streams = [ffmpeg.input(list_file, f='concat', safe=0)['v']]
+        output_kwargs = {'vcodec': 'copy', 'movflags': '+faststart'}
+        if media_info['audio_codec'] is not None:
+            audio = ffmpeg.input(input_file, ss=clip_begin)['a:0'].filter('atrim', duration=length).filter('asetpts', 'PTS-STARTPTS')
+            if volume is not None and volume != 1.0:
+                audio = audio.filter('volume', volume)
+            streams.append(audio)
+            output_kwargs['acodec'] = 'aac'
+        stream = ffmpeg.output(*streams, output_file, **output_kwargs)
+        run_ffmpeg(stream, length, mux_progress)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class ProgressLogger(proglog.ProgressBarLogger):
+    def __init__(self, progress):
+        super().__init__()
+        self.progress = progress
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        # This method is called whenever an attribute of a bar changes
+        check_cancelled()
+        if self.progress and bar == 't' and attr == 'index':
+            self.progress(value / self.bars['t']['total'])
+
+
+def moviepy_export(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, progress=None):
+    # Next to the output instead of the working directory, so a cancelled export can remove it
+    temp_audiofile = os.path.splitext(output_file)[0] + '-audio.m4a'
+    video = VideoFileClip(input_file)
+    try:
+        clip = video
+        if clip_begin or clip_end:
+            clip = clip.subclip(clip_begin, clip_end)
+        if resolution_w and resolution_h:
+            clip = clip.resize(newsize=(resolution_w, resolution_h))
+        if volume is not None:
+            clip = clip.fx(afx.volumex, volume)
+
+        kwargs = {
+            'codec': 'libx264',
+            'audio_codec': 'aac',
+            'temp_audiofile': temp_audiofile,
+            'logger': ProgressLogger(progress)
+        }
+        if new_bitrate:
+            kwargs['bitrate'] = f'{new_bitrate}k'
+        clip.write_videofile(output_file, **kwargs)
+    finally:
+        video.close()
+        if os.path.exists(temp_audiofile):
+            os.remove(temp_audiofile)
+
+
+def modified_time(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def remove_partial_output(output_file, original_mtime):
+    # A file that was not touched is an earlier export the cancelled job never got to overwrite
+    mtime = modified_time(output_file)
+    if mtime is not None and mtime != original_mtime:
+        try:
+            os.remove(output_file)
+        except OSError as e:
+            print(f"Failed to remove partial output {output_file}: {e}")
+
+
+def run_job(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, mode="reencode", segments=None, progress=None):
+    # Shared by the GUI export thread and the command line, returns the path that was written
+    output_file = resolve_output_file(input_file, output_file)
+    original_mtime = modified_time(output_file)
+    try:
+        export_file(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, mode, segments, progress)
+    except ExportCancelled:
+        remove_partial_output(output_file, original_mtime)
+        raise
+    return output_file
+
+
+def export_file(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, mode, segments, progress):
+    if mode == "copy":
+        fast_trim(input_file, output_file, clip_begin, clip_end, progress)
+    elif mode == "smart":
+        smart_cut(input_file, output_file, clip_begin, clip_end, volume, progress)
+    elif mode == "ffmpeg":
+        filter_export(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, progress)
+    elif mode == "parallel":
+        parallel_export(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, segments, progress)
+    elif mode == "reencode":
+        moviepy_export(input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, progress)
+    else:
+        raise ValueError(f"Unknown export mode: {mode}")
+
+
+def error_message(error):
+    # ffmpeg.Error only says "see stderr output", the reason is in its stderr
+    message = str(error)
+    if isinstance(error, ffmpeg.Error) and error.stderr:
+        message = f"{message}: {error.stderr.decode(errors='replace').strip()}"
+    return message
+
+
+def watch_cancel(cancel_connection):
+    # A cancel message, or the GUI going away, stops the export at its next progress report
+    try:
+        cancel_connection.recv()
+    except (EOFError, OSError):
+        pass
+    cancel_requested.set()
+
+
+def export_worker(settings, connection, cancel_connection):
+    # Entry point of the export process, only whole-percent progress and the result cross the pipe
+    threading.Thread(target=watch_cancel, args=(cancel_connection,), daemon=True).start()
+    last_percent = -1
+
+    def progress(fraction):
+        nonlocal last_percent
+        percent = int(fraction * 100)
+        if percent != last_percent:
+            last_percent = percent
+            connection.send(('progress', percent))
+
+    try:
+        connection.send(('done', run_job(progress=progress, **settings)))
+    except ExportCancelled:
+        try:
+            connection.send(('cancelled', None))
+        except OSError:
+            pass
+    except Exception as e:
+        try:
+            connection.send(('error', error_message(e)))
+        except OSError:
+            # The GUI is gone, the export has been cleaned up all the same
+            pass
+    finally:
+        connection.close()
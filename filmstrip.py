@@ -0,0 +1,144 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from PySide6.QtCore import QObject, QThread, QEvent, QRect, Signal
+from PySide6.QtGui import QImage, QPainter
+from PySide6.QtWidgets import QStyle
+import numpy as np
+import ffmpeg
+
+from probe import content_key, cache_file
+
+# Thumbnail height for each zoom level as a fraction of the slider height, smaller thumbnails fit more of them
+ZOOM_LEVELS = {
+    "Overview": 1.0,
+    "Normal": 0.75,
+    "Detail": 0.5,
+}
+DEFAULT_ZOOM = "Normal"
+THUMBNAIL_HEIGHT = 48
+
+
+def track_rect(slider, zoom):
+    # The part of the slider the handle centre travels over, the strip is centred vertically
+    handle = slider.style().pixelMetric(QStyle.PM_SliderLength, None, slider)
+    height = max(1, round(slider.height() * zoom))
+    return QRect(handle // 2, (slider.height() - height) // 2, max(1, slider.width() - handle), height)
+
+
+def thumbnail_count(slider, media_info, zoom):
+    # As many thumbnails as fit the slider's track at the source aspect ratio, so none of them are stretched
+    track = track_rect(slider, zoom)
+    thumbnail_width = track.height() * media_info['width'] / media_info['height']
+    return max(1, round(track.width() / thumbnail_width))
+
+
+def decode_thumbnail(path, time, width, height):
+    # Keyframe only, the decoder skips every other frame
+    stream = (
+        ffmpeg.input(path, ss=time, noaccurate_seek=None, skip_frame='nokey')
+        .video.filter('scale', width, height)
+        .output('pipe:', format='rawvideo', pix_fmt='rgb24', vframes=1)
+        .global_args('-loglevel', 'error', '-nostdin')
+    )
+    data = subprocess.run(stream.compile(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    if len(data) < width * height * 3:
+        return np.zeros((height, width, 3), np.uint8)
+    return np.frombuffer(data[:width * height * 3], np.uint8).reshape(height, width, 3)
+
+
+class FilmstripWorker(QThread):
+    ready = Signal(str, QImage, int, int)
+
+    def __init__(self, path, media_info, count, begin, end):
+        super().__init__()
+        self.path = path
+        self.media_info = media_info
+        self.count = count
+        # The sprite covers one slider range, so it is drawn over that slider without cropping
+        self.begin = begin
+        self.end = end
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        height = THUMBNAIL_HEIGHT
+        width = max(2, round(height * self.media_info['width'] / self.media_info['height']))
+        try:
+            sprite_file = cache_file('filmstrip', [content_key(self.path), self.count, height, self.begin, self.end], '.png')
+        except OSError as e:
+            print(f"Error reading {self.path}: {e}")
+            return
+
+        image = QImage(sprite_file) if os.path.isfile(sprite_file) else QImage()
+        if image.isNull():
+            span = self.end - self.begin
+            times = [self.begin + span * (index + 0.5) / self.count for index in range(self.count)]
+            with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+                futures = [executor.submit(decode_thumbnail, self.path, time, width, height) for time in times]
+                thumbnails = []
+                for future in futures:
+                    if self.cancelled:
+                        executor.shutdown(cancel_futures=True)
+                        return
+                    thumbnails.append(future.result())
+            sprite = np.ascontiguousarray(np.hstack(thumbnails))
+            image = QImage(sprite.data, sprite.shape[1], sprite.shape[0], sprite.strides[0], QImage.Format_RGB888).copy()
+            if not image.save(sprite_file):
+                print(f"Failed to write filmstrip cache {sprite_file}")
+
+        if not self.cancelled:
+            self.ready.emit(self.path, image, self.begin, self.end)
+
+
+class FilmstripPainter(QObject):
+    # Paints under each slider, before the slider draws itself, the sprite built for the slider's current range
+    layoutChanged = Signal()
+
+    def __init__(self, sliders, parent=None):
+        super().__init__(parent)
+        self.sliders = sliders
+        self.sprites = {}
+        self.zoom = ZOOM_LEVELS[DEFAULT_ZOOM]
+        for slider in self.sliders:
+            slider.installEventFilter(self)
+
+    def ranges(self):
+        return {(slider.minimum(), slider.maximum()) for slider in self.sliders}
+
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+        self.clear()
+
+    def set_sprite(self, sprite, begin, end):
+        # Sprites of ranges no slider shows any more are dropped
+        self.sprites[(begin, end)] = sprite
+        self.sprites = {key: image for key, image in self.sprites.items() if key in self.ranges()}
+        for slider in self.sliders:
+            slider.update()
+
+    def clear(self):
+        self.sprites = {}
+        for slider in self.sliders:
+            slider.update()
+
+    def eventFilter(self, watched, event):
+        if event.type() == QEvent.Paint:
+            # A slider whose range has no sprite yet stays plain until its own sprite is built
+            sprite = self.sprites.get((watched.minimum(), watched.maximum()))
+            if sprite is not None:
+                self.paint_strip(watched, sprite)
+        elif event.type() == QEvent.Resize:
+            # A wider or narrower track needs another thumbnail count
+            self.layoutChanged.emit()
+        return False
+
+    def paint_strip(self, slider, sprite):
+        painter = QPainter(slider)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.setOpacity(0.6)
+        painter.drawImage(track_rect(slider, self.zoom), sprite)
+        painter.end()
@@ -0,0 +1,286 @@
+import threading
+import multiprocessing
+from time import monotonic
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from preview import FrameRing, StreamDecoder, RING_SLOTS, PREVIEW_PIX_FMT
+
+# A server that has not answered a request for this long is treated as hung and restarted
+SERVER_TIMEOUT = 10
+
+
+class SharedFrameRing(FrameRing):
+    # A FrameRing whose slots live in one shared memory block, so another process can decode into them
+    def __init__(self, shape, slots=RING_SLOTS, name=None):
+        frame_size = int(np.prod(shape))
+        self.owner = name is None
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=frame_size * slots)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        buffers = [np.ndarray(shape, np.uint8, self.memory.buf, slot * frame_size) for slot in range(slots)]
+        super().__init__(shape, slots, buffers)
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.disposed = False
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def release(self, slot):
+        super().release(slot)
+        # A retired ring is freed as soon as the GUI hands back its last frame
+        if self.closed:
+            self.dispose_if_idle()
+
+    def dispose_if_idle(self):
+        if self.free.qsize() == self.slots:
+            self.dispose()
+
+    def dispose(self):
+        with self.lock:
+            if self.disposed:
+                return
+            self.disposed = True
+        self.close()
+        self.buffers = []
+        try:
+            self.memory.close()
+        except BufferError:
+            # A frame from this ring is still referenced, the mapping goes away with it
+            pass
+        if self.owner:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ServedDecoder(StreamDecoder):
+    # The decoder inside the server process, it fills the slots of the GUI's shared ring
+    def __init__(self, path, width, height, fps, keyframes, pix_fmt, ring_name):
+        self.ring_name = ring_name
+        self.lock = threading.Lock()
+        self.sequence = None
+        super().__init__(path, width, height, fps, keyframes, pix_fmt)
+
+    def make_ring(self, shape):
+        return SharedFrameRing(shape, name=self.ring_name)
+
+    def resize(self, width, height):
+        ring = self.ring
+        super().resize(width, height)
+        ring.dispose()
+
+    def configure(self, width, height, output_fps, threads, ring_name):
+        self.ring_name = ring_name
+        super().configure(width, height, output_fps, threads)
+
+    def run_request(self, sequence, fill, *args):
+        with self.lock:
+            self.sequence = sequence
+        try:
+            return fill(*args)
+        finally:
+            with self.lock:
+                self.sequence = None
+
+    def interrupt_request(self, sequence):
+        # An interrupt that arrives after its request finished must not kill the next one
+        with self.lock:
+            if sequence == self.sequence:
+                self.interrupt()
+
+
+def watch_interrupts(decoder, interrupts):
+    while True:
+        try:
+            sequence = interrupts.recv()
+        except (EOFError, OSError):
+            break
+        decoder.interrupt_request(sequence)
+
+
+def serve(path, width, height, fps, keyframes, pix_fmt, ring_name, connection, interrupts):
+    # Entry point of the server process, replies are only (complete, pts, time), the pixels are already in the ring
+    decoder = ServedDecoder(path, width, height, fps, keyframes, pix_fmt, ring_name)
+    threading.Thread(target=watch_interrupts, args=(decoder, interrupts), daemon=True).start()
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        action = message[0]
+        if action == 'seek':
+            decoder.seek(message[1])
+        elif action == 'read':
+            complete = decoder.run_request(message[2], decoder.fill, message[1])
+            connection.send((complete, decoder.pts, decoder.time))
+        elif action == 'keyframe':
+            complete = decoder.run_request(message[3], decoder.fill_keyframe, message[1], message[2])
+            connection.send((complete, decoder.pts, decoder.time))
+        elif action == 'configure':
+            decoder.configure(*message[1:])
+        elif action == 'keyframes':
+            decoder.set_keyframes(message[1])
+        elif action == 'source':
+            decoder.set_source(message[1], message[2])
+        elif action == 'quit':
+            break
+    decoder.close()
+    decoder.ring.dispose()
+
+
+class RemoteDecoder(StreamDecoder):
+    # Same interface as StreamDecoder for FrameGrab, but ffmpeg is driven from a child process that writes
+    # into shared memory, so decoding never holds the GUI process's GIL and a dead server is just restarted
+    def __init__(self, path, width, height, fps, keyframes=None, pix_fmt=PREVIEW_PIX_FMT):
+        super().__init__(path, width, height, fps, keyframes, pix_fmt)
+        self.retired_rings = []
+        self.sequence = 0
+        self.restarts = 0
+        self.closing = False
+        self.server = None
+        self.start_server()
+
+    def make_ring(self, shape):
+        return SharedFrameRing(shape)
+
+    def start_server(self):
+        context = multiprocessing.get_context('spawn')
+        self.connection, server_connection = context.Pipe()
+        interrupts, self.interrupts = context.Pipe(duplex=False)
+        self.server = context.Process(
+            target=serve,
+            args=(self.path, self.width, self.height, self.fps, self.keyframes, self.pix_fmt, self.ring.name, server_connection, interrupts),
+            daemon=True
+        )
+        self.server.start()
+        server_connection.close()
+        interrupts.close()
+        if (self.output_fps, self.threads) != (self.fps, 0):
+            self.send_configuration()
+
+    def stop_server(self):
+        try:
+            self.connection.send(('quit',))
+        except OSError:
+            pass
+        self.server.join(1)
+        if self.server.is_alive():
+            self.server.kill()
+            self.server.join()
+        self.connection.close()
+        self.interrupts.close()
+
+    def restart(self):
+        # Never during shutdown, the new server would only be killed again
+        if self.closing:
+            return
+        print("Preview frame server stopped responding, restarting it")
+        self.server.kill()
+        self.stop_server()
+        self.restarts += 1
+        self.start_server()
+        # The new server continues where the old one was, so playback keeps its position
+        if self.time >= 0:
+            self.send(('seek', self.time))
+
+    def call(self, message):
+        # Returns the server's reply, or None after replacing a server that died or hung, or once closing
+        try:
+            self.connection.send(message)
+            deadline = monotonic() + SERVER_TIMEOUT
+            while not self.closing and monotonic() < deadline:
+                if self.connection.poll(0.1):
+                    return self.connection.recv()
+        except (EOFError, OSError):
+            pass
+        self.restart()
+        return None
+
+    def request(self, *message):
+        # A request that cost the server its life is sent once more to the restarted one
+        for attempt in range(2):
+            self.sequence += 1
+            reply = self.call(message + (self.sequence,))
+            if reply is not None or self.closing:
+                return reply
+        return None
+
+    def send(self, message):
+        try:
+            self.connection.send(message)
+        except OSError:
+            self.restart()
+
+    def seek(self, time):
+        self.send(('seek', time))
+        self.time = time
+
+    def resize(self, width, height):
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * self.channels
+        # Frames of the old ring may still be on screen, it is freed once they have all been handed back
+        self.ring.close()
+        self.retired_rings = [ring for ring in self.retired_rings if not ring.disposed] + [self.ring]
+        self.ring.dispose_if_idle()
+        self.ring = self.make_ring((height, width, self.channels))
+
+    def restart_pipe(self):
+        # The server restarts its pipe when it applies the configuration
+        pass
+
+    def configure(self, width, height, output_fps, threads):
+        super().configure(width, height, output_fps, threads)
+        self.send_configuration()
+
+    def set_keyframes(self, keyframes):
+        self.keyframes = keyframes
+        self.send(('keyframes', keyframes))
+
+    def set_source(self, path, keyframes):
+        # Kept locally as well, a restarted server opens the current source
+        self.path = path
+        self.keyframes = keyframes
+        self.send(('source', path, keyframes))
+
+    def send_configuration(self):
+        self.send(('configure', self.width, self.height, self.output_fps, self.threads, self.ring.name))
+
+    def fill(self, slot):
+        reply = self.request('read', slot)
+        if reply is None:
+            return False
+        complete, self.pts, self.time = reply
+        return complete
+
+    def fill_keyframe(self, time, slot):
+        reply = self.request('keyframe', time, slot)
+        if reply is None:
+            return False
+        complete, self.pts, self.time = reply
+        return complete
+
+    def interrupt(self):
+        # Called from the GUI thread, the server kills its ffmpeg process if that request is still running
+        try:
+            self.interrupts.send(self.sequence)
+        except OSError:
+            pass
+
+    def abort(self):
+        # Called from the GUI thread before close(), a pending call returns at once and nothing is restarted
+        self.closing = True
+        self.interrupt()
+
+    def close(self):
+        self.closing = True
+        self.stop_server()
+        for ring in self.retired_rings + [self.ring]:
+            ring.dispose()
+        self.retired_rings = []
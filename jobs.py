@@ -0,0 +1,176 @@
+import os
+import itertools
+
+from PySide6.QtCore import Qt, QObject, Signal
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QTableWidget, QTableWidgetItem, QProgressBar, QHeaderView
+
+
+# How long a cancelled export may take to stop its ffmpeg processes and remove its temp files
+CANCEL_TIMEOUT_MS = 5000
+
+
+def default_concurrency():
+    # Every export already runs a multi-threaded encoder, so only a few fit before the CPU is oversubscribed
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
+class ExportJob:
+    _ids = itertools.count(1)
+
+    def __init__(self, settings):
+        self.id = next(self._ids)
+        self.settings = settings
+        self.status = "Queued"
+        self.progress = 0
+        self.error = None
+        self.thread = None
+
+
+class JobQueue(QObject):
+    jobAdded = Signal(object)
+    jobChanged = Signal(object)
+    progress = Signal(int)
+
+    def __init__(self, thread_factory, max_running=None, parent=None):
+        super().__init__(parent)
+        self.thread_factory = thread_factory
+        self.max_running = max_running or default_concurrency()
+        self.jobs = []
+        self.batch = []
+        self.pending = []
+        self.running = []
+
+    def add(self, settings):
+        job = ExportJob(settings)
+        if not self.pending and not self.running:
+            self.batch = []
+        self.jobs.append(job)
+        self.batch.append(job)
+        self.pending.append(job)
+        self.jobAdded.emit(job)
+        self.schedule()
+        return job
+
+    def schedule(self):
+        while self.pending and len(self.running) < self.max_running:
+            job = self.pending.pop(0)
+            job.thread = self.thread_factory(**job.settings)
+            job.thread.progress.connect(lambda value, job=job: self.job_progress(job, value))
+            job.thread.finished.connect(lambda job=job: self.job_finished(job))
+            job.status = "Running"
+            self.running.append(job)
+            self.jobChanged.emit(job)
+            job.thread.start()
+
+    def job_progress(self, job, value):
+        job.progress = value
+        self.jobChanged.emit(job)
+        self.emit_progress()
+
+    def job_finished(self, job):
+        job.thread.quit()
+        job.thread.wait()
+        self.running.remove(job)
+        job.error = job.thread.error
+        if job.thread.cancelled:
+            job.status = "Cancelled"
+        else:
+            job.status = "Failed" if job.error else "Done"
+        job.progress = 100
+        self.jobChanged.emit(job)
+        self.emit_progress()
+        self.schedule()
+
+    def remove(self, job):
+        # Finished jobs only, the thread and its process handle are released with it
+        self.jobs.remove(job)
+        if job.thread is not None:
+            job.thread.deleteLater()
+            job.thread = None
+
+    def cancel_all(self, timeout=CANCEL_TIMEOUT_MS):
+        # Nothing new is started, running jobs get timeout ms to clean up before their process is killed
+        self.pending.clear()
+        for job in self.running:
+            job.thread.cancel()
+        for job in self.running:
+            if not job.thread.wait(timeout):
+                job.thread.kill()
+                job.thread.wait()
+
+    def active_count(self):
+        return len(self.running)
+
+    def emit_progress(self):
+        # Overall progress covers the jobs added since the queue was last idle
+        if self.batch:
+            self.progress.emit(int(sum(job.progress for job in self.batch) / len(self.batch)))
+
+
+class QueuePanel(QWidget):
+    addFilesRequested = Signal()
+
+    COLUMNS = ["Input", "Mode", "Status", "Progress", "Error"]
+
+    def __init__(self, job_queue, parent=None):
+        super().__init__(parent, Qt.Tool)
+        self.setWindowTitle("Export Queue")
+        self.resize(700, 300)
+        self.job_queue = job_queue
+        self.rows = {}
+
+        self.table = QTableWidget(0, len(self.COLUMNS), self)
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+
+        self.add_files_button = QPushButton("Add Files...", self)
+        self.add_files_button.clicked.connect(self.addFilesRequested)
+        self.clear_button = QPushButton("Clear Finished", self)
+        self.clear_button.clicked.connect(self.clear_finished)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.add_files_button)
+        buttons.addStretch()
+        buttons.addWidget(self.clear_button)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+
+        self.job_queue.jobAdded.connect(self.add_job)
+        self.job_queue.jobChanged.connect(self.update_job)
+
+    def add_job(self, job):
+        row = self.table.rowCount()
+        self.table.insertRow(row)
+        self.table.setItem(row, 0, QTableWidgetItem(os.path.basename(job.settings['input_file'])))
+        self.table.setItem(row, 1, QTableWidgetItem(job.settings.get('mode', 'reencode')))
+        self.table.setItem(row, 2, QTableWidgetItem(job.status))
+        progress_bar = QProgressBar(self.table)
+        progress_bar.setRange(0, 100)
+        self.table.setCellWidget(row, 3, progress_bar)
+        self.table.setItem(row, 4, QTableWidgetItem())
+        self.rows[job.id] = job
+        self.update_job(job)
+
+    def row_of(self, job):
+        return list(self.rows).index(job.id)
+
+    def update_job(self, job):
+        if job.id not in self.rows:
+            return
+        row = self.row_of(job)
+        self.table.item(row, 2).setText(job.status)
+        self.table.cellWidget(row, 3).setValue(job.progress)
+        if job.error:
+            # ffmpeg errors span several lines, the first is shown and the whole text is in the tooltip
+            error_item = self.table.item(row, 4)
+            error_item.setText(job.error.splitlines()[0])
+            error_item.setToolTip(job.error)
+
+    def clear_finished(self):
+        for job_id, job in list(self.rows.items()):
+            if job.status in ("Done", "Failed", "Cancelled"):
+                self.table.removeRow(self.row_of(job))
+                del self.rows[job_id]
+                self.job_queue.remove(job)
@@ -4,22 +4,26 @@
 import sys
 import os
 import platform
-import proglog
+import multiprocessing
 
-from moviepy.video.io.VideoFileClip import VideoFileClip
-import moviepy.audio.fx.all as afx
 import ffmpeg
 
-from PySide6.QtWidgets import QApplication, QMainWindow, QPushButton, QCheckBox, QLineEdit, QFileDialog, QMessageBox, QSlider, QTimeEdit, QProgressBar, QLabel, QStyle
+from PySide6.QtWidgets import QApplication, QMainWindow, QPushButton, QCheckBox, QLineEdit, QFileDialog, QMessageBox, QSlider, QTimeEdit, QProgressBar, QLabel, QStyle, QComboBox, QSpinBox
 from PySide6.QtUiTools import QUiLoader
 from PySide6.QtCore import Qt, QThread, Signal, QTime, QTimer
 from PySide6.QtGui import QFontDatabase, QFont, QIntValidator, QIcon
 
-import resources_rc
 from preview import *
+from jobs import JobQueue, QueuePanel
+from media import MediaSession
+from filmstrip import FilmstripPainter, thumbnail_count, ZOOM_LEVELS, DEFAULT_ZOOM
+import export
 
-# Set the OpenGL attribute before creating the QApplication
-QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
+# How often the GUI time per frame and dropped frames readout is refreshed
+PREVIEW_STATS_MS = 1000
+
+# Slider ranges settle for this long before their filmstrips are rebuilt
+FILMSTRIP_DEBOUNCE_MS = 500
 
 cwd = os.getcwd()
 
@@ -27,7 +31,7 @@ class VideoProcessingThread(QThread):
     progress = Signal(int)
     finished = Signal()
 
-    def __init__(self, input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate):
+    def __init__(self, input_file, output_file, clip_begin, clip_end, resolution_w, resolution_h, volume, new_bitrate, mode="reencode", segments=None):
         super().__init__()
         self.input_file = input_file
         self.output_file = output_file
@@ -37,55 +41,81 @@ class VideoProcessingThread(QThread):
         self.resolution_h = resolution_h
         self.volume = volume
         self.new_bitrate = new_bitrate
+        self.mode = mode
+        self.segments = segments
+        self.error = None
+        self.cancelled = False
+        self.process = None
+        self.cancel_sender = None
 
     def run(self):
-        class CustomLogger(proglog.ProgressBarLogger):
-            def __init__(self, progress_signal):
-                super().__init__()
-                self.progress_signal = progress_signal
-
-            def bars_callback(self, bar, attr, value, old_value=None):
-                # This method is called whenever an attribute of a bar changes
-                if bar == 't' and attr == 'index':
-                    total = self.bars['t']['total']
-                    index = value
-                    progress = index / total
-                    percentage = int(progress * 100)
-                    self.progress_signal.emit(percentage)
-
-
+        # The export runs in its own process so moviepy's per-frame work never competes with the preview for the GIL
+        settings = {
+            'input_file': self.input_file,
+            'output_file': self.output_file,
+            'clip_begin': self.clip_begin,
+            'clip_end': self.clip_end,
+            'resolution_w': self.resolution_w,
+            'resolution_h': self.resolution_h,
+            'volume': self.volume,
+            'new_bitrate': self.new_bitrate,
+            'mode': self.mode,
+            'segments': self.segments,
+        }
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        cancel_receiver, self.cancel_sender = context.Pipe(duplex=False)
+        self.process = context.Process(target=export.export_worker, args=(settings, sender, cancel_receiver))
         try:
-            logger = CustomLogger(self.progress)
-
-            # Proceed with video processing
-            video = VideoFileClip(self.input_file)
-            if self.clip_begin or self.clip_end:
-                video = video.subclip(self.clip_begin, self.clip_end)
-            if self.resolution_w and self.resolution_h:
-                video = video.resize(newsize=(self.resolution_w, self.resolution_h))
-            if self.volume is not None:
-                video = video.fx(afx.volumex, self.volume)
-
-            kwargs = {
-                'codec': 'libx264',
-                'audio_codec': 'aac',
-                'logger': logger  # Use the custom logger
-            }
-            if self.new_bitrate:
-                kwargs['bitrate'] = f'{self.new_bitrate}k'
-            if not self.output_file:
-                self.output_file = os.path.splitext(self.input_file)[0] + '-modified.mp4'
+            self.process.start()
+            sender.close()
+            cancel_receiver.close()
+            done = False
+            while True:
+                try:
+                    kind, value = receiver.recv()
+                except EOFError:
+                    break
+                if kind == 'progress':
+                    self.progress.emit(value)
+                elif kind == 'done':
+                    self.output_file = value
+                    done = True
+                elif kind == 'error':
+                    self.error = value
+                elif kind == 'cancelled':
+                    self.cancelled = True
+            self.process.join()
+            if not done and not self.cancelled and self.error is None:
+                self.error = f"Export process exited with code {self.process.exitcode}"
+            if self.cancelled:
+                print("Export cancelled")
+            elif self.error is None:
+                print("Video created successfully")
             else:
-                self.output_file = self.output_file + '.mp4'
-
-            # Write the video file with the custom logger
-            video.write_videofile(self.output_file, **kwargs)
-            print("Video created successfully")
+                print(f"Error processing video: {self.error}")
         except Exception as e:
+            self.error = str(e)
             print(f"Error processing video: {e}")
         finally:
+            receiver.close()
+            self.cancel_sender.close()
             self.finished.emit()
 
+    def cancel(self):
+        # The worker stops at its next progress report and cleans up its ffmpeg processes and temp files itself
+        if self.cancel_sender is None:
+            return
+        try:
+            self.cancel_sender.send(('cancel',))
+        except OSError:
+            pass
+
+    def kill(self):
+        # Last resort for a worker that does not react to cancel()
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+
     def update_progress(self, percentage):
         self.progress.emit(percentage)
     
@@ -118,10 +148,12 @@ class VideoEditor(QMainWindow):
                 icon_path = os.path.abspath('icons/videoeditor_icon.png')
 
         loader = QUiLoader()
-        
+        loader.registerCustomWidget(PreviewSurface)
+
         self.ui = loader.load(ui_file_path)
         self.setCentralWidget(self.ui)
-        self.setFixedSize(self.ui.size())
+        # Resizable, the preview follows the window and its decoder is reconfigured for the new size
+        self.resize(self.ui.size())
         self.setWindowTitle("Video Editor v0.1.0")
         self.setWindowIcon(QIcon(icon_path))
 
@@ -156,6 +188,21 @@ class VideoEditor(QMainWindow):
         self.progress_bar.setMaximum(100)
         self.progress_bar.setValue(0)
 
+        self.export_mode = self.ui.findChild(QComboBox, "export_mode")
+        self.export_mode.addItem("Re-encode", "reencode")
+        self.export_mode.addItem("Fast trim (stream copy)", "copy")
+        self.export_mode.addItem("Smart cut (frame accurate)", "smart")
+        self.export_mode.addItem("Re-encode (native ffmpeg)", "ffmpeg")
+        self.export_mode.addItem("Parallel segments (native ffmpeg)", "parallel")
+
+        self.segments_spin = self.ui.findChild(QSpinBox, "segments_spin")
+        self.segments_spin.setRange(1, 64)
+        self.segments_spin.setValue(os.cpu_count() or 1)
+        self.segments_spin.setEnabled(False)
+
+        self.queue_button = self.ui.findChild(QPushButton, "queue_button")
+        self.job_queue = JobQueue(VideoProcessingThread, parent=self)
+        self.queue_panel = QueuePanel(self.job_queue, self)
 
         self.res_w.setValidator(QIntValidator(8, 7680, self))
         self.res_h.setValidator(QIntValidator(4, 4320, self))
@@ -174,7 +221,24 @@ class VideoEditor(QMainWindow):
         self.start_time_slider.setRange(0, 0)
         self.end_time_slider.setRange(0, 0)
 
-        self.preview = self.ui.findChild(QLabel, "preview")
+        self.filmstrip = FilmstripPainter([self.start_time_slider, self.end_time_slider], self)
+        self.filmstrip_zoom = self.ui.findChild(QComboBox, "filmstrip_zoom")
+        self.filmstrip_zoom.addItems(list(ZOOM_LEVELS))
+        self.filmstrip_zoom.setCurrentText(DEFAULT_ZOOM)
+        # Moving a cut point changes the other slider's range, its strip is rebuilt once the handle settles
+        self.filmstrip_timer = QTimer(self)
+        self.filmstrip_timer.setSingleShot(True)
+        self.filmstrip_timer.setInterval(FILMSTRIP_DEBOUNCE_MS)
+
+        self.preview = self.ui.findChild(PreviewSurface, "preview")
+        self.preview_quality_label = self.ui.findChild(QLabel, "preview_quality_label")
+        self.preview_quality_label.setToolTip("Preview resolution and frame rate are lowered while exports are running")
+        self.preview_stats_label = self.ui.findChild(QLabel, "preview_stats_label")
+        self.preview_stats_label.setToolTip("GUI-thread time spent per displayed frame over the last second, and frames dropped so far")
+        self.preview_stats_timer = QTimer(self)
+        self.preview_stats_timer.setInterval(PREVIEW_STATS_MS)
+        # Hook deciding the preview quality from the number of running exports, see QUALITY_LEVELS
+        self.quality_policy = export_quality_policy
         self.play = self.ui.findChild(QPushButton, "play")
         self.play.setIcon(self.style().standardIcon(QStyle.SP_MediaPlay))
         self.play_pause = "play"
@@ -186,6 +250,10 @@ class VideoEditor(QMainWindow):
         self.video_time_text = self.ui.findChild(QTimeEdit, "preview_time_text")
         self.video_time_text.setDisplayFormat("HH:mm:ss")
 
+        self.session = None
+        self.preview_video = None
+        self.frame_cache = FrameCache(FRAME_CACHE_MB)
+
         self.connect_objects()
 
     def connect_objects(self):
@@ -197,8 +265,26 @@ class VideoEditor(QMainWindow):
         self.start_time.timeChanged.connect(self.start_time_to_slider)
         self.end_time_slider.valueChanged.connect(self.slider_to_end_time)
         self.end_time.timeChanged.connect(self.end_time_to_slider)
+        for slider in (self.start_time_slider, self.end_time_slider):
+            slider.sliderPressed.connect(self.slider_pressed)
+            slider.sliderReleased.connect(self.slider_released)
         self.play.clicked.connect(self.play_pause_clicked)
         self.stop.clicked.connect(self.stop_clicked)
+        self.export_mode.currentIndexChanged.connect(self.export_mode_changed)
+        self.filmstrip_zoom.currentTextChanged.connect(self.filmstrip_zoom_changed)
+        for slider in (self.start_time_slider, self.end_time_slider):
+            slider.rangeChanged.connect(self.filmstrip_timer.start)
+        self.filmstrip.layoutChanged.connect(self.filmstrip_timer.start)
+        self.filmstrip_timer.timeout.connect(self.update_filmstrip)
+        self.queue_button.clicked.connect(self.queue_panel.show)
+        self.queue_panel.addFilesRequested.connect(self.batch_add_files)
+        self.job_queue.progress.connect(self.update_progress_bar)
+        self.job_queue.jobChanged.connect(self.update_preview_quality)
+        self.preview_stats_timer.timeout.connect(self.update_preview_stats)
+        self.preview_stats_timer.start()
+
+    def export_mode_changed(self):
+        self.segments_spin.setEnabled(self.export_mode.currentData() == "parallel")
 
     def play_pause_clicked(self):
         if self.input_file_text.text():
@@ -221,6 +307,14 @@ class VideoEditor(QMainWindow):
             self.preview_video.frame_grab.stop()
             self.play_stop = "stop"
     
+    def slider_pressed(self):
+        if self.preview_video is not None:
+            self.preview_video.begin_scrub()
+
+    def slider_released(self):
+        if self.preview_video is not None:
+            self.preview_video.end_scrub()
+
     def update_volume_lcd(self, value):
         self.volume_number.setText(str(value))
 
@@ -248,7 +342,8 @@ class VideoEditor(QMainWindow):
         seconds = value % 60
         self.start_time.setTime(QTime(hours, minutes, seconds))
         self.end_time.setMinimumTime(QTime(hours, minutes, seconds))
-        self.preview_video.set_time(value, "start", self.play_pause, self.play_stop)
+        if self.preview_video is not None:
+            self.preview_video.set_time(value, "start", self.play_pause, self.play_stop)
 
     def slider_to_end_time(self, value):
         hours = value // 3600
@@ -256,14 +351,16 @@ class VideoEditor(QMainWindow):
         seconds = value % 60
         self.end_time.setTime(QTime(hours, minutes, seconds))
         self.start_time.setMaximumTime(QTime(hours, minutes, seconds))
-        self.preview_video.set_time(value, "end")
+        if self.preview_video is not None:
+            self.preview_video.set_time(value, "end", self.play_pause, self.play_stop)
 
     def start_time_to_slider(self):
         total_seconds = self.time_to_seconds(self.start_time.time())
         self.end_time_slider.setRange(total_seconds, self.video_duration)
         self.start_time_slider.blockSignals(True)
         self.start_time_slider.setValue(total_seconds)
-        self.preview_video.set_time(total_seconds, "start", self.play_pause, self.play_stop)
+        if self.preview_video is not None:
+            self.preview_video.set_time(total_seconds, "start", self.play_pause, self.play_stop)
         self.start_time_slider.blockSignals(False)
 
     def end_time_to_slider(self):
@@ -271,7 +368,8 @@ class VideoEditor(QMainWindow):
         self.start_time_slider.setRange(0, total_seconds)
         self.end_time_slider.blockSignals(True)
         self.end_time_slider.setValue(total_seconds)
-        self.preview_video.set_time(total_seconds, "end")
+        if self.preview_video is not None:
+            self.preview_video.set_time(total_seconds, "end", self.play_pause, self.play_stop)
         self.end_time_slider.blockSignals(False)
 
     def time_to_seconds(self, time):
@@ -286,6 +384,12 @@ class VideoEditor(QMainWindow):
         formatted_time = QTime(hours, minutes, seconds)
         return formatted_time
 
+    def format_seconds(self, time):
+        hours = int(time // 3600)
+        minutes = int((time % 3600) // 60)
+        seconds = time % 60
+        return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
     def select_input_file(self):
         file_name, _ = QFileDialog.getOpenFileName(
             self,
@@ -298,10 +402,20 @@ class VideoEditor(QMainWindow):
                 self.input_file_text.setText(file_name)
             else:
                 QMessageBox.warning(self, "Invalid File", "The selected file is not valid.")
+        if not self.input_file_text.text():
+            return
 
-        self.video_duration = VideoFileClip(self.input_file_text.text()).duration
-        
-        self.preview_video = VideoPreviewWidget(VideoFileClip(self.input_file_text.text(), target_resolution=(360, 640)), self.preview, self.video_time_text)
+        # Release the previous file's readers before opening the next one
+        self.close_session()
+        try:
+            self.session = MediaSession(self.input_file_text.text(), self.preview, self.video_time_text, self.frame_cache)
+        except (ffmpeg.Error, ValueError, OSError) as e:
+            QMessageBox.warning(self, "Invalid File", f"The selected file could not be read: {e}")
+            return
+        self.video_duration = self.session.duration
+        self.preview_video = self.session.preview_video
+        self.update_preview_quality()
+        self.session.build_keyframes().ready.connect(self.keyframes_ready)
 
         # Calculate maximum time from video duration (in seconds)
         self.max_time = self.seconds_to_time(self.video_duration)
@@ -312,14 +426,76 @@ class VideoEditor(QMainWindow):
         self.end_time_slider.setRange(0, self.video_duration)
         self.slider_to_end_time(self.video_duration)
         self.end_time_to_slider()
+        # Built for the new file's slider ranges, not whatever the previous file left behind
+        self.update_filmstrip()
+
+    def update_preview_quality(self):
+        quality = self.quality_policy(self.job_queue.active_count())
+        proxy = " (proxy)" if self.session is not None and self.session.proxy_path else ""
+        self.preview_quality_label.setText(f"Preview: {quality}{proxy}")
+        if self.preview_video is not None:
+            self.preview_video.set_quality(quality)
+
+    def filmstrip_zoom_changed(self, zoom):
+        self.filmstrip.set_zoom(ZOOM_LEVELS[zoom])
+        self.update_filmstrip()
+
+    def update_preview_stats(self):
+        if self.preview_video is None:
+            self.preview_stats_label.clear()
+            return
+        cost = self.preview.recent_frame_cost()
+        frame_time = f"{cost:.2f} ms/frame" if cost is not None else "idle"
+        self.preview_stats_label.setText(f"GUI: {frame_time}, dropped: {self.preview_video.frame_grab.dropped_frames}")
 
-    def run_button_clicked(self):
-        print("Run button clicked")
-        self.input_file = self.input_file_text.text()
-
-        if not self.input_file:
-            print("No input file selected. Please input a filename to be edited.")
+    def update_filmstrip(self):
+        self.filmstrip_timer.stop()
+        if self.session is None:
             return
+        strips = set()
+        for slider in (self.start_time_slider, self.end_time_slider):
+            if slider.maximum() > slider.minimum():
+                strips.add((thumbnail_count(slider, self.session.info, self.filmstrip.zoom), slider.minimum(), slider.maximum()))
+        for worker in self.session.build_filmstrip(sorted(strips)):
+            worker.ready.connect(self.filmstrip_ready)
+
+    def filmstrip_ready(self, path, image, begin, end):
+        # Queued signals of a closed session may still arrive, only the open file's sprites are shown
+        if self.session is not None and self.session.path == path:
+            self.filmstrip.set_sprite(image, begin, end)
+
+    def keyframes_ready(self, path, keyframes):
+        if self.session is not None and self.session.path == path and self.session.keyframes is None:
+            self.session.use_keyframes(keyframes)
+            # The GOP length decides whether a proxy is needed
+            worker = self.session.build_proxy()
+            if worker is not None:
+                worker.ready.connect(self.proxy_ready)
+
+    def proxy_ready(self, path):
+        if self.session is not None:
+            self.session.use_proxy(path)
+            self.update_preview_quality()
+
+    def close_session(self):
+        self.filmstrip.clear()
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+            self.preview_video = None
+
+    def closeEvent(self, event):
+        self.close_session()
+        # Export processes would otherwise keep the application alive after the window is gone
+        self.job_queue.cancel_all()
+        super().closeEvent(event)
+
+    def collect_job_settings(self, input_file=None):
+        input_file = input_file or self.input_file_text.text()
+
+        if not input_file:
+            print("No input file selected. Please input a filename to be edited.")
+            return None
 
         clip_begin = self.start_time_slider.value()
         clip_end = self.end_time_slider.value()
@@ -328,25 +504,25 @@ class VideoEditor(QMainWindow):
 
         if self.output_file_check.isChecked():
             try:
-                self.output_file = str(self.output_file_text.text()).removesuffix('.mp4')
+                output_file = str(self.output_file_text.text()).removesuffix('.mp4')
             except ValueError:
-                self.output_file = None
+                output_file = None
                 print("Invalid output name input.")
         else:
-            self.output_file = None
+            output_file = None
 
         if self.res_w_check.isChecked():
             try:
                 resolution_w = int(self.res_w.text())
             except ValueError:
                 print("Invalid resolution width.")
-                return
+                return None
         if self.res_h_check.isChecked():
             try:
                 resolution_h = int(self.res_h.text())
             except ValueError:
                 print("Invalid resolution height.")
-                return
+                return None
         if self.bitrate_check.isChecked():
             try:
                 new_bitrate = int(self.bitrate_text.text())
@@ -358,22 +534,74 @@ class VideoEditor(QMainWindow):
 
         volume = float(self.volume_slider.value()/100)
 
-        self.thread = VideoProcessingThread(
-            input_file=self.input_file,
-            output_file=self.output_file,
-            clip_begin=clip_begin,
-            clip_end=clip_end,
-            resolution_w=resolution_w,
-            resolution_h=resolution_h,
-            volume=volume,
-            new_bitrate=new_bitrate
-        )
+        mode = self.export_mode.currentData()
+        if mode == "copy":
+            if resolution_w or resolution_h or new_bitrate or volume != 1.0:
+                QMessageBox.warning(self, "Fast Trim", "Fast trim copies the streams as they are. Clear the resolution, bitrate and volume changes or choose Re-encode.")
+                return None
+        elif mode == "smart":
+            if resolution_w or resolution_h or new_bitrate:
+                QMessageBox.warning(self, "Smart Cut", "Smart cut keeps the source encoding. Clear the resolution and bitrate changes or choose Re-encode.")
+                return None
+
+        return {
+            'input_file': input_file,
+            'output_file': output_file,
+            'clip_begin': clip_begin,
+            'clip_end': clip_end,
+            'resolution_w': resolution_w,
+            'resolution_h': resolution_h,
+            'volume': volume,
+            'new_bitrate': new_bitrate,
+            'mode': mode,
+            'segments': self.segments_spin.value(),
+        }
+
+    def run_button_clicked(self):
+        print("Run button clicked")
+        settings = self.collect_job_settings()
+        if settings is None:
+            return
 
-        # Connect the progress signal to the update method
-        self.thread.progress.connect(self.update_progress_bar)
-        print('Thread created and progress signal connected')
-        self.thread.finished.connect(self.thread.quit)
-        self.thread.start()
+        if settings['mode'] == "copy":
+            # The index is built in the background when the file is opened, it is never scanned on the GUI thread
+            if self.session is None or self.session.path != settings['input_file']:
+                QMessageBox.warning(self, "Fast Trim", "Open the file before trimming it.")
+                return
+            if self.session.keyframes is None:
+                QMessageBox.information(self, "Fast Trim", "The keyframes of this file are still being indexed, try again in a moment.")
+                return
+            clip_begin, clip_end = export.snap_to_keyframes(settings['input_file'], settings['clip_begin'], settings['clip_end'], self.video_duration, self.session.keyframes)
+            answer = QMessageBox.question(
+                self,
+                "Fast Trim",
+                f"Cut points snapped to the nearest keyframes:\n\n"
+                f"Start: {self.format_seconds(clip_begin)}\n"
+                f"End: {self.format_seconds(clip_end)}\n\nExport with these times?"
+            )
+            if answer != QMessageBox.Yes:
+                return
+            settings['clip_begin'] = clip_begin
+            settings['clip_end'] = clip_end
+
+        self.job_queue.add(settings)
+        self.queue_panel.show()
+
+    def batch_add_files(self):
+        file_names, _ = QFileDialog.getOpenFileNames(
+            self,
+            "Add Videos to Queue",
+            os.path.expanduser(cwd),
+            "Video Files (*.mp4 *.avi *.mov);;All Files (*)"
+        )
+        if not file_names:
+            return
+        settings = self.collect_job_settings(file_names[0])
+        if settings is None:
+            return
+        # Batch jobs export whole files with the current encode settings
+        for file_name in file_names:
+            self.job_queue.add(dict(settings, input_file=file_name, output_file=None, clip_begin=0, clip_end=None))
 
     def update_progress_bar(self, value):
         print(f"Updating progress bar to {value}%")
@@ -381,6 +609,11 @@ class VideoEditor(QMainWindow):
 
 if __name__ == "__main__":
     # main()
+    multiprocessing.freeze_support()
+    # Spawned export workers and frame servers import this file as __mp_main__, the GUI-only setup stays here
+    import resources_rc
+    # Set the OpenGL attribute before creating the QApplication
+    QApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication([])
     window = VideoEditor()
     window.show()
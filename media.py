@@ -0,0 +1,118 @@
+from PySide6.QtCore import QThread, Signal
+import ffmpeg
+
+from preview import VideoPreviewWidget
+from frameserver import RemoteDecoder
+from filmstrip import FilmstripWorker
+from proxy import ProxyWorker, needs_proxy
+from probe import probe_media, keyframe_index, cache_key
+
+
+# Indexing cannot be interrupted, workers of closed sessions are kept alive here until they finish
+_finishing_workers = set()
+
+
+class KeyframeWorker(QThread):
+    # The path comes with the index, a queued signal can still arrive after its session was closed
+    ready = Signal(str, object)
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def run(self):
+        try:
+            keyframes = keyframe_index(self.path)
+        except (ffmpeg.Error, OSError) as e:
+            print(f"Error indexing keyframes of {self.path}: {e}")
+            return
+        self.ready.emit(self.path, keyframes)
+
+
+class MediaSession:
+    # Owns everything opened for the current input file, close() releases it all
+    def __init__(self, path, preview, video_time_text, frame_cache=None):
+        self.path = path
+        self.info = probe_media(path)
+        # The keyframe index needs a full demux, it is built by build_keyframes() off the GUI thread
+        self.keyframes = None
+        self.keyframe_worker = None
+        # Size and mtime are part of the id, so frames of an overwritten file are never reused
+        self.media_id = tuple(cache_key(path))
+        # Decoding runs in a frame server process, the GUI process only maps the shared frame ring
+        self.preview_video = VideoPreviewWidget(path, self.info, preview, video_time_text, self.keyframes, frame_cache, self.media_id, RemoteDecoder)
+        self.filmstrip_workers = []
+        self.proxy_worker = None
+        self.proxy_path = None
+
+    @property
+    def duration(self):
+        return self.info['duration']
+
+    def build_filmstrip(self, strips):
+        # One sprite per (count, begin, end), sliders showing the same range share it
+        self.stop_filmstrip()
+        for count, begin, end in strips:
+            worker = FilmstripWorker(self.path, self.info, count, begin, end)
+            worker.start()
+            self.filmstrip_workers.append(worker)
+        return self.filmstrip_workers
+
+    def stop_filmstrip(self):
+        for worker in self.filmstrip_workers:
+            worker.cancel()
+        for worker in self.filmstrip_workers:
+            worker.wait()
+        self.filmstrip_workers = []
+
+    def build_keyframes(self):
+        self.keyframe_worker = KeyframeWorker(self.path)
+        self.keyframe_worker.start()
+        return self.keyframe_worker
+
+    def use_keyframes(self, keyframes):
+        if self.preview_video is None:
+            return
+        self.keyframes = keyframes
+        # A proxy in use seeks without an index, the original's is only needed once it is back
+        if self.proxy_path is None:
+            self.preview_video.set_keyframes(keyframes)
+
+    def build_proxy(self):
+        # Only heavy sources get one, export always reads self.path
+        if not needs_proxy(self.info, self.keyframes):
+            return None
+        self.proxy_worker = ProxyWorker(self.path)
+        self.proxy_worker.start()
+        return self.proxy_worker
+
+    def use_proxy(self, proxy_path):
+        if self.proxy_worker is None or proxy_path != self.proxy_worker.output_file or self.preview_video is None:
+            return
+        self.proxy_path = proxy_path
+        # Every proxy frame is a keyframe, an accurate -ss seek decodes just the one frame without an index
+        self.preview_video.set_source(proxy_path, None)
+
+    def stop_proxy(self):
+        if self.proxy_worker is not None:
+            self.proxy_worker.cancel()
+            self.proxy_worker.wait()
+            self.proxy_worker = None
+
+    def close(self):
+        if self.keyframe_worker is not None:
+            worker = self.keyframe_worker
+            try:
+                worker.ready.disconnect()
+            except (RuntimeError, TypeError):
+                pass
+            if worker.isRunning():
+                _finishing_workers.add(worker)
+                worker.finished.connect(lambda: _finishing_workers.discard(worker))
+            self.keyframe_worker = None
+        self.stop_filmstrip()
+        self.stop_proxy()
+        if self.preview_video is not None:
+            self.preview_video.shutdown()
+            self.preview_video.deleteLater()
+            self.preview_video = None
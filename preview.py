@@ -1,113 +1,832 @@
-from PySide6.QtCore import QThread, Signal, QTimer, QTime
+import re
+import sys
+import queue
+import threading
+import subprocess
+from time import monotonic, perf_counter
+from collections import OrderedDict
+
+from PySide6.QtCore import Qt, QThread, Signal, QTimer, QTime, QRect
 from PySide6.QtWidgets import QWidget
-from PySide6.QtGui import QImage, QPixmap
-from numpy import ndarray
+from PySide6.QtGui import QImage, QPainter, QColor
+import numpy as np
+import ffmpeg
+
+SHOWINFO_PTS = re.compile(rb'pts_time:\s*(-?[0-9.]+)')
+
+STOPPED = "stopped"
+PAUSED = "paused"
+PLAYING = "playing"
+
+# ffmpeg pixel format -> (bytes per pixel, matching QImage format). The 32-bit formats are what Qt
+# paints natively, so the colour conversion happens once in ffmpeg and rows are always 4-byte aligned
+PIXEL_FORMATS = {
+    'bgra': (4, QImage.Format_ARGB32_Premultiplied),
+    'argb': (4, QImage.Format_ARGB32_Premultiplied),
+    'rgb24': (3, QImage.Format_RGB888),
+}
+# Format_ARGB32 is a native-endian 0xAARRGGBB word, which is bgra in memory on little-endian machines
+PREVIEW_PIX_FMT = 'bgra' if sys.byteorder == 'little' else 'argb'
+
+# Decoded frames that can be in flight between the decoder and the GUI at once
+RING_SLOTS = 4
+
+# Default memory budget for decoded preview frames
+FRAME_CACHE_MB = 256
+
+# Preview quality levels, the decode size is scaled down, every nth frame is kept and ffmpeg gets fewer threads
+# (0 lets ffmpeg choose). Lower levels leave the CPU to running exports
+QUALITY_LEVELS = {
+    "Full": {'scale': 1.0, 'fps_divisor': 1, 'threads': 0},
+    "Reduced": {'scale': 0.5, 'fps_divisor': 2, 'threads': 2},
+    "Low": {'scale': 0.25, 'fps_divisor': 4, 'threads': 1},
+}
+DEFAULT_QUALITY = "Full"
+
+# Widget size changes settle for this long before the decoder is reconfigured
+RESIZE_DEBOUNCE_MS = 250
+
+# Playback falling this far behind is treated as a stall and the clock restarts instead of dropping
+RESYNC_THRESHOLD = 0.5
+
+
+def fit_size(source_width, source_height, box_width, box_height):
+    # Largest even size with the source aspect ratio that fits the box, never above the source resolution
+    scale = min(box_width / source_width, box_height / source_height, 1.0)
+    return max(2, int(source_width * scale) // 2 * 2), max(2, int(source_height * scale) // 2 * 2)
+
+
+def export_quality_policy(active_jobs):
+    # Default policy hook, maps the number of running exports to a QUALITY_LEVELS entry
+    if active_jobs == 0:
+        return "Full"
+    if active_jobs == 1:
+        return "Reduced"
+    return "Low"
+
+
+class FrameRing:
+    # Preallocated frame buffers, the decoder fills a free slot and the GUI hands it back after painting
+    def __init__(self, shape, slots=RING_SLOTS, buffers=None):
+        self.buffers = buffers if buffers is not None else [np.empty(shape, np.uint8) for _ in range(slots)]
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.closed = False
+
+    def acquire(self):
+        while not self.closed:
+            try:
+                return self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def close(self):
+        self.closed = True
+
+
+class Frame:
+    # A decoded frame, either borrowed from a FrameRing or owned (cached frames)
+    def __init__(self, array, ring=None, slot=None):
+        self.array = array
+        self.ring = ring
+        self.slot = slot
+
+    def release(self):
+        if self.ring is not None:
+            self.ring.release(self.slot)
+            self.ring = None
+
+
+class FrameHandoff:
+    # At most one frame waits for the GUI, a newer frame replaces it so a busy GUI only ever sees the latest
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame = None
+
+    def put(self, frame):
+        # True when the slot was empty and the GUI has to be told, False when a waiting frame was dropped
+        with self.lock:
+            previous, self.frame = self.frame, frame
+        if previous is not None:
+            previous.release()
+            return False
+        return True
+
+    def take(self):
+        with self.lock:
+            frame, self.frame = self.frame, None
+        return frame
+
+    def clear(self):
+        frame = self.take()
+        if frame is not None:
+            frame.release()
+
+
+class FrameCache:
+    # Decoded frames keyed by (media id, frame index, preview size), least recently used go first
+    def __init__(self, budget_mb=FRAME_CACHE_MB):
+        self.budget = budget_mb * 1024 * 1024
+        self.size = 0
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is not None:
+                self.frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return
+            self.frames[key] = frame
+            self.size += frame.nbytes
+            while self.size > self.budget and self.frames:
+                _, evicted = self.frames.popitem(last=False)
+                self.size -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.size = 0
+
+
+class StreamDecoder:
+    # Reads frames in order from a single ffmpeg pipe, a new process is only started on seek()
+    def __init__(self, path, width, height, fps, keyframes=None, pix_fmt=PREVIEW_PIX_FMT):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.fps = fps
+        # Rate frames are produced at, below fps while the preview is degraded
+        self.output_fps = fps
+        self.threads = 0
+        self.keyframes = keyframes
+        self.pix_fmt = pix_fmt
+        self.channels, self.image_format = PIXEL_FORMATS[pix_fmt]
+        self.frame_size = width * height * self.channels
+        self.ring = self.make_ring((height, width, self.channels))
+        self.process = None
+        self.pts_queue = None
+        self.seek_time = 0
+        self.skip_until = 0
+        self.pts = 0
+        self.time = 0
+
+    def make_ring(self, shape):
+        return FrameRing(shape)
+
+    def resize(self, width, height):
+        # Only the pipe is restarted, the next read reopens it at the current position with the new scale
+        self.close()
+        self.width = width
+        self.height = height
+        self.frame_size = width * height * self.channels
+        # Slots still held by the GUI go back to the old ring, which is simply dropped
+        self.ring.close()
+        self.ring = self.make_ring((height, width, self.channels))
+
+    def configure(self, width, height, output_fps, threads):
+        options_changed = (output_fps, threads) != (self.output_fps, self.threads)
+        self.output_fps = output_fps
+        self.threads = threads
+        if (width, height) != (self.width, self.height):
+            self.resize(width, height)
+        elif options_changed:
+            self.restart_pipe()
+
+    def restart_pipe(self):
+        # The next read reopens the pipe at the current position with the new options
+        self.close()
+
+    def set_keyframes(self, keyframes):
+        # The index arrives after opening, until then seeks are accurate -ss seeks
+        self.keyframes = keyframes
+
+    def set_source(self, path, keyframes):
+        # Same timeline from another file, e.g. the proxy of the original
+        self.path = path
+        self.keyframes = keyframes
+        self.restart_pipe()
+
+    def seek(self, time):
+        keyframe = self.keyframes.before(time) if self.keyframes else None
+        # A forward jump inside the GOP that is already being decoded just reads on
+        if self.process is not None and keyframe is not None and keyframe == self.seek_time and self.time <= time:
+            self.skip_until = time
+            self.time = time
+            return
+
+        self.close()
+        if keyframe is None:
+            source = ffmpeg.input(self.path, ss=time, threads=self.threads)
+            video = source.video
+            self.seek_time = time
+        else:
+            # Open straight at the GOP start, trim drops the frames before the target inside ffmpeg
+            source = ffmpeg.input(self.path, ss=keyframe, noaccurate_seek=None, threads=self.threads)
+            video = source.video.trim(start=time - keyframe)
+            self.seek_time = keyframe
+        if self.output_fps < self.fps:
+            video = video.filter('fps', fps=self.output_fps)
+        # showinfo reports each frame's timestamp on stderr, so VFR sources keep their real timing
+        stream = (
+            video.filter('scale', self.width, self.height)
+            .filter('showinfo')
+            .output('pipe:', format='rawvideo', pix_fmt=self.pix_fmt, vsync=0)
+            .global_args('-loglevel', 'info', '-nostdin', '-hide_banner')
+        )
+        self.process = subprocess.Popen(stream.compile(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.pts_queue = queue.Queue()
+        threading.Thread(target=self.read_timestamps, args=(self.process.stderr, self.pts_queue), daemon=True).start()
+        self.skip_until = time
+        self.time = time
+
+    def read_timestamps(self, stderr, pts_queue):
+        for line in stderr:
+            match = SHOWINFO_PTS.search(line)
+            if match:
+                pts_queue.put(float(match.group(1)))
+
+    def read_into(self, buffer):
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < self.frame_size:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                return False
+            filled += count
+        return True
+
+    def fill(self, slot):
+        # Decodes the next frame at or after skip_until into a ring slot, False at end of stream or when interrupted
+        if self.process is None:
+            self.seek(self.time)
+        buffer = self.ring.buffers[slot]
+        while True:
+            # ffmpeg writes straight into the ring slot, no per-frame allocation
+            if not self.read_into(buffer):
+                # End of stream or interrupted, either way the next read starts a new pipe
+                self.close()
+                self.time = -1.0
+                return False
+            try:
+                self.pts = self.seek_time + self.pts_queue.get(timeout=1)
+            except queue.Empty:
+                self.pts = self.time
+            self.time = self.pts + 1 / self.output_fps
+            if self.pts >= self.skip_until - 0.5 / self.output_fps:
+                return True
+
+    def fill_keyframe(self, time, slot):
+        # Decodes only the keyframe at or before time, cheap enough to follow a slider drag
+        keyframe = self.keyframes.before(time) if self.keyframes else None
+        if keyframe is None:
+            keyframe = time
+        self.close()
+        stream = (
+            ffmpeg.input(self.path, ss=keyframe, noaccurate_seek=None, skip_frame='nokey', threads=self.threads)
+            .video.filter('scale', self.width, self.height)
+            .output('pipe:', format='rawvideo', pix_fmt=self.pix_fmt, vframes=1)
+            .global_args('-loglevel', 'error', '-nostdin')
+        )
+        # Kept in self.process so interrupt() can abandon it like any other decode
+        self.process = subprocess.Popen(stream.compile(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        complete = self.read_into(self.ring.buffers[slot])
+        self.close()
+        # The pipe is closed, so the next read has to seek
+        self.time = -1.0
+        self.pts = keyframe
+        return complete
+
+    def read(self):
+        slot = self.ring.acquire()
+        if slot is None:
+            return None
+        if not self.fill(slot):
+            self.ring.release(slot)
+            return None
+        return Frame(self.ring.buffers[slot], self.ring, slot)
+
+    def read_keyframe(self, time):
+        slot = self.ring.acquire()
+        if slot is None:
+            return None
+        if not self.fill_keyframe(time, slot):
+            self.ring.release(slot)
+            return None
+        return Frame(self.ring.buffers[slot], self.ring, slot)
+
+    def interrupt(self):
+        # Called from the GUI thread, killing the process makes the blocked read return early
+        process = self.process
+        if process is not None:
+            process.kill()
+
+    def abort(self):
+        # Called from the GUI thread before close(), the running decode must not hold up shutdown
+        self.interrupt()
+
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.stdout.close()
+            self.process.wait()
+            self.process = None
+
+
+class PreviewSurface(QWidget):
+    # Keeps the latest frame as a QImage over its ring slot and paints it scaled, no QPixmap per frame
+    sizeChanged = Signal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.frame = None
+        self.image = None
+        self.gui_time = 0.0
+        self.painted_frames = 0
+        self.reported = (0.0, 0)
+        self.watching_screen = False
+
+    def set_frame(self, frame, image_format):
+        started = perf_counter()
+        array = frame.array
+        height, width, channels = array.shape
+        previous = self.frame
+        self.frame = frame
+        self.image = QImage(array.data, width, height, array.strides[0], image_format)
+        # The previous slot is no longer referenced by any QImage, hand it back to the decoder
+        if previous is not None:
+            previous.release()
+        self.gui_time += perf_counter() - started
+        self.update()
+
+    def clear(self):
+        if self.frame is not None:
+            self.frame.release()
+        self.frame = None
+        self.image = None
+        self.update()
+
+    def device_size(self):
+        # Physical pixels, so HiDPI screens get a sharp frame and small windows a cheap one
+        ratio = self.devicePixelRatioF()
+        return round(self.width() * ratio), round(self.height() * ratio)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.sizeChanged.emit()
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        # Moving the window to a screen with another scale factor changes the device size too
+        window = self.window().windowHandle()
+        if window is not None and not self.watching_screen:
+            window.screenChanged.connect(lambda screen: self.sizeChanged.emit())
+            self.watching_screen = True
+
+    def frame_cost(self):
+        # Average GUI-thread milliseconds spent per displayed frame (wrapping plus painting)
+        if not self.painted_frames:
+            return 0.0
+        return self.gui_time / self.painted_frames * 1000
+
+    def recent_frame_cost(self):
+        # Same measurement over the frames painted since the last call, None when nothing was painted
+        gui_time = self.gui_time - self.reported[0]
+        frames = self.painted_frames - self.reported[1]
+        self.reported = (self.gui_time, self.painted_frames)
+        return gui_time / frames * 1000 if frames else None
+
+    def target_rect(self):
+        image_size = self.image.size()
+        image_size.scale(self.size(), Qt.KeepAspectRatio)
+        rect = QRect(0, 0, image_size.width(), image_size.height())
+        rect.moveCenter(self.rect().center())
+        return rect
+
+    def paintEvent(self, event):
+        started = perf_counter()
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), Qt.black)
+        if self.image is None:
+            painter.setPen(Qt.white)
+            painter.drawText(self.rect(), Qt.AlignCenter, "Video Preview")
+        else:
+            painter.drawImage(self.target_rect(), self.image)
+        painter.setPen(QColor("grey"))
+        painter.drawRect(self.rect().adjusted(0, 0, -1, -1))
+        painter.end()
+        if self.image is not None:
+            self.gui_time += perf_counter() - started
+            self.painted_frames += 1
+
 
 class VideoPreviewWidget(QWidget):
-    def __init__(self, video_input, preview, video_time_text):
+    def __init__(self, path, media_info, preview, video_time_text, keyframes=None, frame_cache=None, media_id=None, decoder_factory=StreamDecoder):
         super().__init__()
-        video_clip = video_input
         self.preview = preview
-        
-        # Start the frame grabbing threa
-        self.frame_grab = FrameGrab(video_clip, video_time_text)
+        self.video_time_text = video_time_text
+        self.media_info = media_info
+        self.quality = DEFAULT_QUALITY
+        self.decode_settings = self.decode_config()
+        width, height = self.decode_settings[:2]
+        self.decoder = decoder_factory(path, width, height, media_info['fps'], keyframes)
+
+        # Start the frame grabbing thread
+        self.frame_grab = FrameGrab(self.decoder, media_info['duration'], frame_cache, media_id or path)
         self.frame_grab.frameReady.connect(self.update_frame)
+        self.frame_grab.positionChanged.connect(self.update_position)
         self.frame_grab.start()
 
         self.slider_timer = QTimer(self)
         self.slider_timer.setSingleShot(True)
         self.slider_timer.timeout.connect(self.apply_update)
 
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.timeout.connect(self.apply_config)
+        self.resize_timer.setInterval(RESIZE_DEBOUNCE_MS)
+        self.preview.sizeChanged.connect(self.resize_timer.start)
+
         self.update_type = None
         self.new_time_value = 0
+        self.scrubbing = False
+        self.scrubbed = False
+
+    def decode_config(self):
+        level = QUALITY_LEVELS[self.quality]
+        width, height = self.preview.device_size()
+        width, height = fit_size(self.media_info['width'], self.media_info['height'], width * level['scale'], height * level['scale'])
+        return width, height, self.media_info['fps'] / level['fps_divisor'], level['threads']
+
+    def apply_config(self):
+        decode_settings = self.decode_config()
+        if decode_settings != self.decode_settings:
+            self.decode_settings = decode_settings
+            self.frame_grab.configure(*decode_settings)
+
+    def set_quality(self, quality):
+        if quality != self.quality:
+            self.quality = quality
+            self.apply_config()
+
+    def set_source(self, path, keyframes):
+        self.frame_grab.set_source(path, keyframes)
+
+    def set_keyframes(self, keyframes):
+        self.frame_grab.set_keyframes(keyframes)
 
     def set_time(self, value, update_type, play_pause=None, play_stop=None):
         self.new_time_value = value
         self.update_type = update_type
         self.play_pause = play_pause
         self.play_stop = play_stop
-        self.slider_timer.start(300)
+        if self.scrubbing:
+            # Keyframes only while the slider is held, the exact frame follows on release
+            self.scrubbed = True
+            self.frame_grab.scrub(value)
+        else:
+            self.slider_timer.start(300)
+
+    def begin_scrub(self):
+        self.scrubbing = True
+        self.scrubbed = False
+
+    def end_scrub(self):
+        self.scrubbing = False
+        if self.scrubbed:
+            self.slider_timer.stop()
+            self.apply_update()
 
     def apply_update(self):
         if self.update_type == "start":
             self.frame_grab.update_start(self.new_time_value, self.play_pause, self.play_stop)
         elif self.update_type == "end":
             self.frame_grab.update_end(self.new_time_value)
+            if self.scrubbed:
+                self.frame_grab.peek(self.new_time_value, self.play_pause, self.play_stop)
+        self.scrubbed = False
 
-    def update_frame(self, frame):
-        height, width, channels = frame.shape
-        bytes_per_line = channels * width
-        q_image = QImage(frame.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(q_image)
-        self.preview_label = self.preview.setPixmap(pixmap)
+    def update_frame(self):
+        frame = self.frame_grab.handoff.take()
+        if frame is not None:
+            self.preview.set_frame(frame, self.decoder.image_format)
+
+    def update_position(self, seconds):
+        self.video_time_text.setTime(self.seconds_to_time(seconds))
+
+    def seconds_to_time(self, time):
+        # Calculate maximum time from video duration (in seconds)
+        time = int(time)
+        hours = time // 3600
+        minutes = (time % 3600) // 60
+        seconds = time % 60
+        formatted_time = QTime(hours, minutes, seconds)
+        return formatted_time
+
+    def shutdown(self):
+        self.slider_timer.stop()
+        self.resize_timer.stop()
+        self.preview.sizeChanged.disconnect(self.resize_timer.start)
+        self.frame_grab.frameReady.disconnect(self.update_frame)
+        self.frame_grab.positionChanged.disconnect(self.update_position)
+        self.frame_grab.quit_playback()
+        self.decoder.ring.close()
+        # A long-GOP seek that is already running would otherwise block the GUI until it finishes
+        self.decoder.abort()
+        self.frame_grab.wait()
+        # Frames are handed back before the decoder goes, its ring may be shared memory that is unmapped on close
+        self.frame_grab.handoff.clear()
+        self.preview.clear()
+        self.decoder.close()
 
     def closeEvent(self, event):
-        self.frame_fetcher.stop()  # Stop the thread when the widget is closed
-        self.frame_fetcher.wait()
+        self.shutdown()  # Stop the thread when the widget is closed
         super().closeEvent(event)
 
 
 class FrameGrab(QThread):
-    frameReady = Signal(ndarray)
+    # Only a notification, the frame itself is taken from the handoff so queued signals never hold frames
+    frameReady = Signal()
+    framesDropped = Signal(int)
+    positionChanged = Signal(float)
 
-    def __init__(self, video_clip, video_time_text):
+    def __init__(self, decoder, duration, frame_cache=None, media_id=None):
         super().__init__()
-        self.video_clip = video_clip
-        self.running = True
+        self.decoder = decoder
+        self.frame_cache = frame_cache
+        self.media_id = media_id
+        # Every call from the GUI thread becomes a command, only this thread touches the decoder
+        self.commands = queue.Queue()
+        self.handoff = FrameHandoff()
+        # Frame requests share one slot, a new request replaces the pending one and cancels the running one
+        self.request_lock = threading.Lock()
+        self.pending_request = None
+        self.request_generation = 0
+        self.decoding = False
+        self.state = PLAYING
         self.start_time = 0
         self.timer = 0
-        self.video_time_text = video_time_text
-        self.duration = self.video_clip.duration
+        self.duration = duration
         self.end_time = self.duration
+        self.clock_anchor = None
+        self.dropped_frames = 0
+        self.scrub_keyframe = None
+        self.shown_time = None
 
     def update_start(self, time, play_pause, play_stop):
-        self.stop()
-        self.start_time = time
-        self.timer = time
-        frame = self.video_clip.get_frame(self.timer)  # Get frame at current time
-        self.frameReady.emit(frame)  # Send frame via signal
-        if play_pause == "pause":
-            return
-        if play_stop == "stop":
-            return
-        self.play()
+        resume = play_pause != "pause" and play_stop != "stop"
+        self.commands.put(("start", time))
+        self.request_frame(("seek", time, resume))
 
     def update_end(self, time):
-        self.duration = time
-        self.end_time = time
+        self.commands.put(("end", time))
+
+    def scrub(self, time):
+        self.request_frame(("scrub", time))
+
+    def peek(self, time, play_pause, play_stop):
+        resume = play_pause != "pause" and play_stop != "stop"
+        self.request_frame(("peek", time, resume))
+
+    def configure(self, width, height, output_fps, threads):
+        self.commands.put(("configure", width, height, output_fps, threads))
+
+    def set_source(self, path, keyframes):
+        self.commands.put(("source", path, keyframes))
+
+    def set_keyframes(self, keyframes):
+        self.commands.put(("keyframes", keyframes))
+
+    def play(self):
+        self.commands.put(("play",))
+
+    def pause(self):
+        self.commands.put(("pause",))
+
+    def stop(self):
+        self.commands.put(("stop",))
+
+    def quit_playback(self):
+        self.commands.put(("quit",))
+
+    def request_frame(self, request):
+        with self.request_lock:
+            self.pending_request = request
+            self.request_generation += 1
+            if self.decoding:
+                self.decoder.interrupt()
+        self.commands.put(("wake",))
+
+    def take_request(self):
+        with self.request_lock:
+            request, self.pending_request = self.pending_request, None
+            if request is not None:
+                self.decoding = True
+            return request, self.request_generation
+
+    def is_stale(self, generation):
+        with self.request_lock:
+            self.decoding = False
+            return generation != self.request_generation
+
+    def cache_key(self, time):
+        # The decoded file is part of the key, frames of a proxy never stand in for frames of the original
+        return (self.media_id, self.decoder.path, round(time * self.decoder.fps), (self.decoder.width, self.decoder.height, self.decoder.pix_fmt))
+
+    def cached_frame(self, time, decode):
+        # Start, end and scrub frames are revisited constantly while fine-tuning a cut
+        if self.frame_cache is None:
+            return decode()
+        key = self.cache_key(time)
+        array = self.frame_cache.get(key)
+        if array is not None:
+            return Frame(array)
+        frame = decode()
+        if frame is not None:
+            # Ring slots are reused, the cache keeps its own copy
+            self.frame_cache.put(key, frame.array.copy())
+        return frame
+
+    def next_frame(self):
+        # Playback only repositions the pipe when the timer jumped, e.g. a loop back to start_time
+        if abs(self.decoder.time - self.timer) > 0.5 / self.decoder.output_fps:
+            self.decoder.seek(self.timer)
+        return self.decoder.read()
 
     def run(self):
-        fps = self.video_clip.fps
-        frame_interval = 1 / fps
-        while self.timer < self.duration:
-            if self.running:
-                frame = self.video_clip.get_frame(self.timer)  # Get frame at current time
-                self.frameReady.emit(frame)  # Send frame via signal
-                self.msleep(int(frame_interval * 1000))  # Sleep until the next frame
-                self.timer += frame_interval
-                self.video_time_text.setTime(self.seconds_to_time(self.timer))
+        while True:
+            if self.state == PLAYING or self.pending_request is not None:
+                try:
+                    command = self.commands.get_nowait()
+                except queue.Empty:
+                    command = None
+            else:
+                # Paused or stopped, sleep until the GUI sends something
+                command = self.commands.get()
+
+            # All queued commands are applied before any decoding, so requests see the latest state
+            if command is not None:
+                if command[0] == "quit":
+                    break
+                self.handle(command)
+                continue
+
+            request, generation = self.take_request()
+            if request is not None:
+                self.handle_request(request, generation)
+            elif self.state == PLAYING:
+                self.play_frame()
+
+    def handle(self, command):
+        action = command[0]
+        if action == "play":
+            if self.state != PLAYING:
+                self.clock_anchor = None
                 if self.timer >= self.duration:
                     self.timer = self.start_time
-            
-    def play(self):
-        self.running = True
-        if self.timer >= self.duration:
+                self.state = PLAYING
+        elif action == "pause":
+            self.state = PAUSED
+        elif action == "stop":
+            self.state = STOPPED
             self.timer = self.start_time
+            self.positionChanged.emit(self.timer)
+        elif action == "start":
+            self.state = STOPPED
+            self.start_time = command[1]
+            self.timer = command[1]
+            self.clock_anchor = None
+            self.scrub_keyframe = None
+        elif action == "end":
+            self.duration = command[1]
+            self.end_time = command[1]
+        elif action == "configure":
+            self.decoder.configure(*command[1:])
+            self.refresh()
+        elif action == "keyframes":
+            self.decoder.set_keyframes(command[1])
+            self.scrub_keyframe = None
+        elif action == "source":
+            self.decoder.set_source(command[1], command[2])
+            self.scrub_keyframe = None
+            self.refresh()
 
-    def pause(self):
-        self.running = False
+    def refresh(self):
+        # A still picture is decoded again from the new setup, playback picks it up with the next frame
+        if self.state != PLAYING and self.shown_time is not None:
+            self.request_frame(("peek", self.shown_time, False))
+
+    def emit_frame(self, frame, time):
+        self.shown_time = time
+        if self.handoff.put(frame):
+            self.frameReady.emit()
+        else:
+            # The GUI has not painted the previous frame yet, it was replaced by this one
+            self.dropped_frames += 1
+            self.framesDropped.emit(self.dropped_frames)
+
+    def handle_request(self, request, generation):
+        action = request[0]
+        if action == "seek":
+            _, time, resume = request
+            self.timer = time
+            frame = self.cached_frame(time, self.next_frame)
+            if frame is not None:
+                self.timer = time + 1 / self.decoder.output_fps
+            if self.is_stale(generation):
+                if frame is not None:
+                    frame.release()
+                return
+            if frame is not None:
+                self.emit_frame(frame, time)  # Send frame via signal
+            self.positionChanged.emit(time)
+            if resume:
+                self.state = PLAYING
+        elif action == "scrub":
+            if self.state == PLAYING:
+                self.state = PAUSED
+            time = request[1]
+            keyframes = self.decoder.keyframes
+            keyframe = keyframes.before(time) if keyframes else None
+            if keyframe is None:
+                # Before the first keyframe, fill_keyframe decodes at time as well
+                keyframe = time
+            # Consecutive drag positions inside one GOP show the same keyframe, decode it once
+            if keyframe == self.scrub_keyframe:
+                self.is_stale(generation)
+                return
+            frame = self.cached_frame(keyframe, lambda: self.decoder.read_keyframe(time))
+            if frame is None:
+                self.is_stale(generation)
+                return
+            if self.is_stale(generation):
+                frame.release()
+                return
+            self.scrub_keyframe = keyframe
+            self.emit_frame(frame, keyframe)
+            self.positionChanged.emit(keyframe)
+        elif action == "peek":
+            _, time, resume = request
+            self.scrub_keyframe = None
+            self.timer = time
+            frame = self.cached_frame(time, self.next_frame)
+            if self.is_stale(generation):
+                if frame is not None:
+                    frame.release()
+                return
+            if frame is not None:
+                self.emit_frame(frame, time)
+                self.positionChanged.emit(time)
+            if resume:
+                self.timer = self.start_time
+                self.clock_anchor = None
+                self.state = PLAYING
+
+    def play_frame(self):
+        frame_interval = 1 / self.decoder.output_fps
         if self.timer >= self.duration:
             self.timer = self.start_time
+            self.clock_anchor = None
+        frame = self.next_frame()
+        if frame is None:
+            # Nothing left to read even from the start point, wait for the next play
+            if self.timer == self.start_time:
+                self.state = STOPPED
+            self.timer = self.start_time
+            self.clock_anchor = None
+            return
+        pts = self.decoder.pts
+        self.timer = self.decoder.time
 
-    def stop(self):
-        self.running = False
-        self.timer = self.start_time
-        self.video_time_text.setTime(self.seconds_to_time(self.timer))
+        # Frames are due at anchor + (pts - anchor pts) on the monotonic clock, so decode time never accumulates
+        if self.clock_anchor is None:
+            self.clock_anchor = (monotonic(), pts)
+        due = self.clock_anchor[0] + pts - self.clock_anchor[1]
+        late = monotonic() - due
+        if abs(late) > RESYNC_THRESHOLD:
+            # A stall, or a timestamp jump in the source, restarts the clock instead of dropping or waiting out the gap
+            self.clock_anchor = (monotonic(), pts)
+        elif late > frame_interval:
+            self.dropped_frames += 1
+            self.framesDropped.emit(self.dropped_frames)
+            frame.release()
+            return
+        else:
+            # Waits in steps of at most one frame so pause, seek and quit are never held up
+            while monotonic() < due and self.commands.empty() and self.pending_request is None:
+                self.msleep(max(1, int(min(due - monotonic(), frame_interval) * 1000)))
 
-    def seconds_to_time(self, time):
-        # Calculate maximum time from video duration (in seconds)
-        hours = time // 3600
-        minutes = (time % 3600) // 60
-        seconds = time % 60
-        formatted_time = QTime(hours, minutes, seconds)
-        return formatted_time
\ No newline at end of file
+        self.emit_frame(frame, pts)  # Send frame via signal
+        self.positionChanged.emit(pts)
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import bisect
+import hashlib
+import tempfile
+import threading
+import subprocess
+
+import ffmpeg
+
+CACHE_VERSION = 3
+
+_memory_cache = {}
+_lock = threading.Lock()
+
+
+def cache_dir(name):
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    path = os.path.join(base, 'videoeditor', name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def cache_key(path):
+    # A changed size or mtime means a different file, so stale entries are never returned
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def content_key(path, sample_size=1024 * 1024):
+    # Hashes the size plus the head and tail of the file, so copies and renames still hit the cache
+    size = os.path.getsize(path)
+    digest = hashlib.sha1(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(sample_size))
+        if size > sample_size:
+            f.seek(max(sample_size, size - sample_size))
+            digest.update(f.read(sample_size))
+    return digest.hexdigest()
+
+
+def cache_file(name, key, extension='.json'):
+    digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    return os.path.join(cache_dir(name), digest + extension)
+
+
+def read_cache(name, key):
+    try:
+        with open(cache_file(name, key)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if entry.get('version') != CACHE_VERSION or entry.get('key') != key:
+        return None
+    return entry['data']
+
+
+def write_cache(name, key, data):
+    path = cache_file(name, key)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'key': key, 'data': data}, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Failed to write {name} cache: {e}")
+
+
+def parse_rate(rate):
+    numerator, _, denominator = (rate or '0/1').partition('/')
+    try:
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+class KeyframeIndex:
+    # Keyframe presentation times and byte offsets of the first video stream, sorted by time
+    def __init__(self, times, offsets):
+        self.times = times
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.times)
+
+    def before(self, time):
+        index = bisect.bisect_right(self.times, time)
+        return self.times[index - 1] if index else None
+
+    def after(self, time):
+        index = bisect.bisect_left(self.times, time)
+        return self.times[index] if index < len(self.times) else None
+
+    def nearest(self, time):
+        candidates = [k for k in (self.before(time), self.after(time)) if k is not None]
+        if not candidates:
+            return time
+        return min(candidates, key=lambda keyframe: abs(keyframe - time))
+
+    def offset(self, time):
+        index = bisect.bisect_right(self.times, time)
+        return self.offsets[index - 1] if index else None
+
+
+def read_keyframe_index(path):
+    # Demux only, the keyframe flag is on the packet so no decoder is started. Long recordings have hundreds of
+    # thousands of packets, so they are streamed as csv lines instead of one JSON document
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,pos,flags', '-of', 'csv=p=0', path]
+    # Times are stored relative to the container start, the same timeline -ss uses
+    start_time = probe_media(path)['start_time']
+    keyframes = {}
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=log)
+        for line in process.stdout:
+            pts_time, _, rest = line.decode(errors='replace').strip().partition(',')
+            position, _, flags = rest.partition(',')
+            if 'K' in flags and pts_time not in ('', 'N/A'):
+                keyframes[round(float(pts_time) - start_time, 6)] = int(position) if position.isdigit() else None
+        if process.wait() != 0:
+            log.seek(0)
+            raise ffmpeg.Error('ffprobe', None, log.read())
+    times = sorted(keyframes)
+    return {'times': times, 'offsets': [keyframes[time] for time in times]}
+
+
+def keyframe_index(path):
+    key = cache_key(path)
+    memory_key = ('keyframes',) + tuple(key)
+    with _lock:
+        if memory_key in _memory_cache:
+            return _memory_cache[memory_key]
+
+    data = read_cache('keyframes', key)
+    if data is None:
+        data = read_keyframe_index(path)
+        write_cache('keyframes', key, data)
+
+    index = KeyframeIndex(data['times'], data['offsets'])
+    with _lock:
+        _memory_cache[memory_key] = index
+    return index
+
+
+def read_media_info(path):
+    info = ffmpeg.probe(path)
+    video = next((s for s in info['streams'] if s['codec_type'] == 'video'), None)
+    audio = next((s for s in info['streams'] if s['codec_type'] == 'audio'), None)
+    if video is None:
+        raise ValueError(f"{path} has no video stream")
+    bitrate = info['format'].get('bit_rate')
+    start_time = info['format'].get('start_time')
+    video_bitrate = video.get('bit_rate')
+    return {
+        'duration': float(info['format'].get('duration') or video.get('duration') or 0),
+        'start_time': float(start_time) if start_time not in (None, 'N/A') else 0.0,
+        'fps': parse_rate(video.get('avg_frame_rate')) or parse_rate(video.get('r_frame_rate')),
+        'profile': video.get('profile'),
+        'level': video.get('level'),
+        'width': int(video['width']),
+        'height': int(video['height']),
+        'video_codec': video.get('codec_name'),
+        'pix_fmt': video.get('pix_fmt'),
+        'video_bitrate': int(video_bitrate) if video_bitrate and video_bitrate.isdigit() else None,
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'bitrate': int(bitrate) if bitrate and bitrate.isdigit() else None,
+    }
+
+
+def probe_media(path):
+    key = cache_key(path)
+    memory_key = ('probe',) + tuple(key)
+    with _lock:
+        if memory_key in _memory_cache:
+            return _memory_cache[memory_key]
+
+    media_info = read_cache('probe', key)
+    if media_info is None:
+        media_info = read_media_info(path)
+        write_cache('probe', key, media_info)
+
+    with _lock:
+        _memory_cache[memory_key] = media_info
+    return media_info
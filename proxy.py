@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import subprocess
+
+from PySide6.QtCore import QThread, Signal
+import ffmpeg
+
+from probe import content_key, cache_file
+
+# Proxies are all-intra MJPEG at this height, every frame is a keyframe so a seek decodes one frame
+PROXY_HEIGHT = 540
+PROXY_QUALITY = 5
+
+# Disk budget for all proxies, the least recently used ones are deleted beyond it
+PROXY_CACHE_MB = 20 * 1024
+
+# A running build writes its .tmp file continuously, one untouched this long was left by a crashed or killed run
+PROXY_STALE_TEMP = 3600
+
+# Sources that get a proxy: above 1080p, codecs that are slow to decode, or keyframes further apart than this
+PROXY_CODECS = {'hevc', 'av1', 'vp9'}
+PROXY_MAX_GOP = 2.0
+
+
+def needs_proxy(media_info, keyframes):
+    gop = media_info['duration'] / max(1, len(keyframes))
+    return media_info['height'] > 1080 or media_info['video_codec'] in PROXY_CODECS or gop > PROXY_MAX_GOP
+
+
+def proxy_file(path):
+    return cache_file('proxy', [content_key(path), PROXY_HEIGHT, PROXY_QUALITY], '.mkv')
+
+
+def evict_proxies(keep, budget_mb=PROXY_CACHE_MB):
+    # Proxies are touched whenever they are used, so the oldest modification time is the least recently used
+    directory = os.path.dirname(keep)
+    proxies = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if path == keep or not name.endswith(('.mkv', '.tmp')):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if name.endswith('.tmp'):
+            if time.time() - stat.st_mtime > PROXY_STALE_TEMP:
+                remove_proxy(path)
+        else:
+            proxies.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in proxies) + os.path.getsize(keep)
+    for _, size, path in sorted(proxies):
+        if total <= budget_mb * 1024 * 1024:
+            break
+        if remove_proxy(path):
+            total -= size
+
+
+def remove_proxy(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError as e:
+        print(f"Failed to remove proxy {path}: {e}")
+        return False
+
+
+def start_low_priority(command, **kwargs):
+    # Keeps the proxy encode from competing with the preview and exports. The priority is set after the fork,
+    # a preexec_fn is not safe in a process that runs other threads
+    if sys.platform == 'win32':
+        return subprocess.Popen(command, creationflags=subprocess.BELOW_NORMAL_PRIORITY_CLASS, **kwargs)
+    process = subprocess.Popen(command, **kwargs)
+    try:
+        os.setpriority(os.PRIO_PROCESS, process.pid, 10)
+    except OSError as e:
+        print(f"Failed to lower the proxy encoder's priority: {e}")
+    return process
+
+
+class ProxyWorker(QThread):
+    ready = Signal(str)
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.output_file = None
+        self.process = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        process = self.process
+        if process is not None:
+            process.kill()
+
+    def run(self):
+        try:
+            self.output_file = proxy_file(self.path)
+        except OSError as e:
+            print(f"Error reading {self.path}: {e}")
+            return
+
+        if not os.path.isfile(self.output_file):
+            temp_file = f'{self.output_file}.{os.getpid()}.tmp'
+            stream = (
+                ffmpeg.input(self.path)
+                .video.filter('scale', -2, f'min({PROXY_HEIGHT},ih)')
+                .output(temp_file, format='matroska', vcodec='mjpeg', pix_fmt='yuvj420p', **{'q:v': PROXY_QUALITY})
+                .global_args('-loglevel', 'error', '-nostdin', '-y')
+            )
+            self.process = start_low_priority(stream.compile(), stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if self.cancelled:
+                self.process.kill()
+            _, error = self.process.communicate()
+            if self.cancelled or self.process.returncode != 0:
+                if not self.cancelled:
+                    print(f"Failed to create a proxy for {self.path}: {error.decode(errors='replace').strip()}")
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+                return
+            os.replace(temp_file, self.output_file)
+        else:
+            os.utime(self.output_file)
+
+        try:
+            evict_proxies(self.output_file)
+        except OSError as e:
+            print(f"Failed to trim the proxy cache: {e}")
+        if not self.cancelled:
+            self.ready.emit(self.output_file)